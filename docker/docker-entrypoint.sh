@@ -1,4 +1,11 @@
 #!/bin/bash
 set -e
 
+# The thread event streams are served by a second uwsgi, in gevent mode
+case "${THREAD_EVENTS,,}" in
+    true|1|yes|on)
+        uwsgi --ini /app/docker/uwsgi.events.ini &
+        ;;
+esac
+
 exec uwsgi --ini /app/docker/uwsgi.http.ini
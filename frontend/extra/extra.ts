@@ -15,6 +15,7 @@ export const context = {
   threadRefno: null as number,
   locked: false,
   sticky: false,
+  threadEvents: false,
 
   persistence: null as Persistence,
   qr: null as QR
@@ -95,6 +96,7 @@ const init = function () {
     context.threadRefno = pageDetails.threadRefno || null;
     context.locked = pageDetails.locked || false;
     context.sticky = pageDetails.sticky || false;
+    context.threadEvents = pageDetails.threadEvents || false;
 
     context.persistence = new Persistence();
 
@@ -190,7 +192,8 @@ const init = function () {
         let postForm = <HTMLElement>document.querySelector('.post-form');
         postForm.style.display = 'none';
 
-        let watcher = new Watcher(context.boardName, context.threadRefno, thread, threadView, watchStatusElements);
+        let watcher = new Watcher(context.boardName, context.threadRefno, thread, threadView, watchStatusElements,
+          context.threadEvents);
 
         context.qr = new QR(watcher, context.persistence);
         for (let i = 0; i < openQrControls.length; i++) {
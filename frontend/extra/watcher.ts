@@ -14,6 +14,7 @@ export class Watcher {
   statusElements: HTMLElement[];
 
   xhr: XMLHttpRequest = null;
+  eventSource: EventSource = null;
   error = false;
 
   timeoutId = -1;
@@ -24,7 +25,7 @@ export class Watcher {
   documentTitle: string;
   totalNewPosts = 0;
 
-  constructor(boardName, threadRefno, thread: Thread, threadView: ThreadView, statusElements) {
+  constructor(boardName, threadRefno, thread: Thread, threadView: ThreadView, statusElements, threadEvents = false) {
     this.boardName = boardName;
     this.threadRefno = threadRefno;
     this.thread = thread;
@@ -38,10 +39,21 @@ export class Watcher {
     document.addEventListener('scroll', (e) => this.onScroll(e), false);
     PageVisibility.addListener((visible) => this.pageVisibilityChanged(visible));
 
+    if (threadEvents && window['EventSource']) {
+      this.openEvents();
+    }
+
     this.updateTimerState(this.delays[0] * 1000);
     this.updateStatus();
   }
 
+  openEvents() {
+    this.eventSource = new EventSource(this.endPoint + this.boardName + '/' + this.threadRefno + '/events');
+    // Also fires after a reconnect, fetch what was posted in the meantime
+    this.eventSource.addEventListener('open', () => this.forceUpdate());
+    this.eventSource.addEventListener('post', () => this.forceUpdate());
+  }
+
   updateTimerState(delay: number) {
     if (this.timeoutId >= 0) {
       clearTimeout(this.timeoutId);
@@ -67,7 +79,16 @@ export class Watcher {
 
   update() {
     if (this.xhr == null) {
-      this.xhr = xhrJsonGet(this.endPoint + this.boardName + '/' + this.threadRefno, this.xhrDone.bind(this));
+      let url = this.endPoint + this.boardName + '/' + this.threadRefno;
+      // Only request the posts we don't have yet
+      let lastRefno = 0;
+      for (let i = 0; i < this.thread.posts.length; i++) {
+        lastRefno = Math.max(lastRefno, this.thread.posts[i].refno);
+      }
+      if (lastRefno > 0) {
+        url += '?after=' + lastRefno;
+      }
+      this.xhr = xhrJsonGet(url, this.xhrDone.bind(this));
       this.updateStatus();
     }
   }
@@ -88,6 +109,11 @@ export class Watcher {
     if (!PageVisibility.isVisible()) {
       delay = Math.max(60, delay);
     }
+
+    // New posts are pushed, only poll as a fallback
+    if (this.eventSource != null && this.eventSource.readyState == EventSource.OPEN) {
+      delay = this.delays[this.delays.length - 1];
+    }
     this.updateTimerState(delay * 1000);
   }
 
@@ -0,0 +1,30 @@
+"""Add post cooldown indexes
+
+Revision ID: 3b9d0c5e7a21
+Revises: d5d3bcb14e53
+Create Date: 2026-10-18 12:04:31.218350
+
+"""
+
+# revision identifiers, used by Alembic.
+revision = "3b9d0c5e7a21"
+down_revision = "d5d3bcb14e53"
+branch_labels = None
+depends_on = None
+
+from alembic import op
+
+
+def upgrade():
+    op.create_index("ix_post_ip4_date", "post", ["ip4", "date"], unique=False)
+    op.create_index(
+        "ix_post_thread_id_ip4_date",
+        "post",
+        ["thread_id", "ip4", "date"],
+        unique=False,
+    )
+
+
+def downgrade():
+    op.drop_index("ix_post_thread_id_ip4_date", table_name="post")
+    op.drop_index("ix_post_ip4_date", table_name="post")
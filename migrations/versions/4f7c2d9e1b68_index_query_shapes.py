@@ -0,0 +1,64 @@
+"""Index the query shapes, drop the text indexes
+
+Revision ID: 4f7c2d9e1b68
+Revises: 8e41f2a6c9d3
+Create Date: 2026-10-18 16:41:09.503127
+
+"""
+
+# revision identifiers, used by Alembic.
+revision = "4f7c2d9e1b68"
+down_revision = "8e41f2a6c9d3"
+branch_labels = None
+depends_on = None
+
+from alembic import op
+
+
+def upgrade():
+    op.create_index(
+        "ix_thread_board_id_refno", "thread", ["board_id", "refno"], unique=False
+    )
+    op.create_index(
+        "ix_thread_board_id_last_modified",
+        "thread",
+        ["board_id", "last_modified"],
+        unique=False,
+    )
+    op.create_index("ix_post_thread_id_id", "post", ["thread_id", "id"], unique=False)
+    op.create_index(
+        "ix_moderatorlog_board_id_date",
+        "moderatorlog",
+        ["board_id", "date"],
+        unique=False,
+    )
+
+    # Covered by the indexes above, and by ix_post_ip4_date. The refno of a thread is
+    # only queried together with its board_id.
+    op.drop_index("ix_thread_board_id", table_name="thread")
+    op.drop_index("ix_thread_refno", table_name="thread")
+    op.drop_index("ix_post_thread_id", table_name="post")
+    op.drop_index("ix_post_ip4", table_name="post")
+    op.drop_index("ix_moderatorlog_board_id", table_name="moderatorlog")
+
+    # Not used by any query, and too large for a btree with long texts
+    op.drop_index("ix_post_text", table_name="post")
+    op.drop_index("ix_page_content", table_name="page")
+
+
+def downgrade():
+    op.create_index("ix_page_content", "page", ["content"], unique=False)
+    op.create_index("ix_post_text", "post", ["text"], unique=False)
+
+    op.create_index(
+        "ix_moderatorlog_board_id", "moderatorlog", ["board_id"], unique=False
+    )
+    op.create_index("ix_post_ip4", "post", ["ip4"], unique=False)
+    op.create_index("ix_post_thread_id", "post", ["thread_id"], unique=False)
+    op.create_index("ix_thread_refno", "thread", ["refno"], unique=False)
+    op.create_index("ix_thread_board_id", "thread", ["board_id"], unique=False)
+
+    op.drop_index("ix_moderatorlog_board_id_date", table_name="moderatorlog")
+    op.drop_index("ix_post_thread_id_id", table_name="post")
+    op.drop_index("ix_thread_board_id_last_modified", table_name="thread")
+    op.drop_index("ix_thread_board_id_refno", table_name="thread")
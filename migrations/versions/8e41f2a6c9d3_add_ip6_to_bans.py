@@ -0,0 +1,28 @@
+"""Add ip6 to bans
+
+Revision ID: 8e41f2a6c9d3
+Revises: 3b9d0c5e7a21
+Create Date: 2026-10-18 13:21:47.562913
+
+"""
+
+# revision identifiers, used by Alembic.
+revision = "8e41f2a6c9d3"
+down_revision = "3b9d0c5e7a21"
+branch_labels = None
+depends_on = None
+
+import sqlalchemy as sa
+from alembic import op
+from sqlalchemy.dialects import postgresql
+
+
+def upgrade():
+    op.add_column("ban", sa.Column("ip6", postgresql.CIDR(), nullable=True))
+    op.alter_column("ban", "ip4", existing_type=sa.BigInteger(), nullable=True)
+
+
+def downgrade():
+    op.execute("DELETE FROM ban WHERE ip6 IS NOT NULL")
+    op.alter_column("ban", "ip4", existing_type=sa.BigInteger(), nullable=False)
+    op.drop_column("ban", "ip6")
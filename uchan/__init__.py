@@ -50,6 +50,7 @@ def init_app():
     create_web_app(config, app)
 
     database.register_teardown(app)
+    database.register_statement_counter(app)
 
     # Setup session handling
     from uchan.flask.custom_session import CustomSessionInterface
@@ -1,15 +1,29 @@
+import multiprocessing
+import time
+
 import click
-from sqlalchemy import inspect
+from sqlalchemy import inspect, text
 
 from uchan import app
 from uchan.lib import roles
+from uchan.lib.cache import cache, codec
 from uchan.lib.database import (
     create_all_tables_and_alembic_version_table,
     get_sqlalchemy_engine,
+    session,
+)
+from uchan.lib.model import ModeratorModel, PageModel, PostModel, ThreadModel
+from uchan.lib.ormmodel import PostOrmModel
+from uchan.lib.repository import moderators, pages, posts
+from uchan.lib.service import (
+    ban_service,
+    board_service,
+    moderator_service,
+    page_service,
+    posts_service,
+    site_service,
 )
-from uchan.lib.model import ModeratorModel, PageModel
-from uchan.lib.repository import moderators, pages
-from uchan.lib.service import moderator_service, page_service
+from uchan.lib.utils import now
 
 
 @app.cli.command("createdb")
@@ -60,3 +74,347 @@ def createdb(create_default_mod: bool, skip_exists: bool):
         "First-time setup complete! You can now login at the moderation portal "
         "with the default credentials (username 'admin' and password 'password')."
     )
+
+
+@app.cli.command("warm-cache")
+@click.option("--threads", default=10, help="Most recently bumped threads per board.")
+@click.option("--workers", default=4, help="Number of parallel worker processes.")
+def warm_cache(threads: int, workers: int):
+    """Fill the caches of all boards, for after a deploy or a memcached restart."""
+
+    start_time = time.perf_counter()
+
+    print("* Site")
+    site_time = _warm_site()
+    print(f"+ site config and board names ({site_time:.0f}ms)")
+
+    board_names = board_service.get_all_board_names()
+    print(f"* {len(board_names)} boards, {workers} workers")
+
+    pool = None
+    if workers > 1:
+        # The workers are forked, each opens its own memcache and database connections
+        pool = multiprocessing.get_context("fork").Pool(
+            workers, initializer=_warm_worker_init
+        )
+    map_unordered = pool.imap_unordered if pool else map
+
+    thread_jobs = []
+    board_time = 0
+    results = map_unordered(_warm_board, [(i, threads) for i in board_names])
+    for i, (board_name, thread_refnos, elapsed) in enumerate(results, 1):
+        board_time += elapsed
+        thread_jobs += [(board_name, refno) for refno in thread_refnos]
+        print(f"[{i}/{len(board_names)}] /{board_name}/ ({elapsed:.0f}ms)")
+
+    print(f"* {len(thread_jobs)} threads")
+    thread_time = 0
+    results = map_unordered(_warm_thread, thread_jobs)
+    for i, (board_name, thread_refno, elapsed) in enumerate(results, 1):
+        thread_time += elapsed
+        if i % 50 == 0 or i == len(thread_jobs):
+            print(f"[{i}/{len(thread_jobs)}] /{board_name}/{thread_refno}")
+
+    if pool:
+        pool.close()
+        pool.join()
+
+    total_time = (time.perf_counter() - start_time) * 1000
+    print(
+        f"Warmed in {total_time:.0f}ms, site: {site_time:.0f}ms, "
+        f"boards: {board_time:.0f}ms, threads: {thread_time:.0f}ms "
+        f"(summed over the workers)"
+    )
+
+
+def _warm_worker_init():
+    cache.reconnect()
+    get_sqlalchemy_engine().dispose(close=False)
+
+
+def _warm_site():
+    start_time = time.perf_counter()
+    site_service.get_site_config()
+    board_service.get_all_board_names()
+    return (time.perf_counter() - start_time) * 1000
+
+
+def _warm_board(args):
+    board_name, threads = args
+    start_time = time.perf_counter()
+
+    thread_refnos = []
+    board = board_service.find_board(board_name)
+    if board:
+        catalog = posts_service.get_catalog(board)
+        for page in range(board.config.pages):
+            posts_service.get_board_page(board, page)
+
+        bumped = sorted(catalog.threads, key=lambda i: i.last_modified, reverse=True)
+        thread_refnos = list(map(lambda i: i.refno, bumped[:threads]))
+
+    return board_name, thread_refnos, (time.perf_counter() - start_time) * 1000
+
+
+def _warm_thread(args):
+    board_name, thread_refno = args
+    start_time = time.perf_counter()
+
+    board = board_service.find_board(board_name)
+    if board:
+        posts_service.find_thread_by_board_thread_refno_with_posts(board, thread_refno)
+
+    return board_name, thread_refno, (time.perf_counter() - start_time) * 1000
+
+
+@app.cli.command("cache-benchmark")
+@click.option("--threads", default=20, help="Number of threads per board to use.")
+@click.option("--rounds", default=10, help="Times to encode and decode each thread.")
+def cache_benchmark(threads: int, rounds: int):
+    """Compare the cache codecs on the thread caches of the boards."""
+
+    thread_caches = []
+    for board_item in board_service.get_all_boards():
+        board = board_service.find_board(board_item.name)
+        catalog = posts_service.get_catalog(board)
+        for thread_stub in catalog.threads[:threads]:
+            thread = posts_service.find_thread_by_board_thread_refno_with_posts(
+                board, thread_stub.refno
+            )
+            if thread:
+                thread_caches.append(
+                    thread.to_cache(include_board=True, include_posts=True)
+                )
+
+    if not thread_caches:
+        print("No threads found")
+        return
+
+    codecs = [
+        ("legacy", codec.CacheCodec(codec.SERIALIZER_LEGACY)),
+        ("json", codec.CacheCodec(codec.SERIALIZER_JSON)),
+        ("json+zlib", codec.CacheCodec(codec.SERIALIZER_JSON, 1)),
+    ]
+    if codec.msgpack is not None:
+        codecs += [
+            ("msgpack", codec.CacheCodec(codec.SERIALIZER_MSGPACK)),
+            ("msgpack+zlib", codec.CacheCodec(codec.SERIALIZER_MSGPACK, 1)),
+        ]
+    else:
+        print("msgpack is not installed, skipping msgpack")
+
+    print(f"* {len(thread_caches)} threads, {rounds} rounds")
+    print(
+        f"{'codec':<14}{'encode ms':>12}{'decode ms':>12}"
+        f"{'total bytes':>14}{'largest':>12}"
+    )
+    for name, cache_codec in codecs:
+        encoded = []
+        start_time = time.perf_counter()
+        for _ in range(rounds):
+            encoded = list(map(lambda i: cache_codec.encode(i), thread_caches))
+        encode_time = (time.perf_counter() - start_time) * 1000 / rounds
+
+        start_time = time.perf_counter()
+        for _ in range(rounds):
+            for data in encoded:
+                cache_codec.decode(data)
+        decode_time = (time.perf_counter() - start_time) * 1000 / rounds
+
+        sizes = list(map(lambda i: len(i), encoded))
+        print(
+            f"{name:<14}{encode_time:>12.2f}{decode_time:>12.2f}"
+            f"{sum(sizes):>14}{max(sizes):>12}"
+        )
+
+
+@app.cli.command("cooldown-benchmark")
+@click.option("--samples", default=200, help="Number of recent posts to check for.")
+@click.option("--rounds", default=5, help="Times to check each post.")
+@click.option(
+    "--window", default=0, help="Cooldown in ms to check, 0 for the real cooldowns."
+)
+def cooldown_benchmark(samples: int, rounds: int, window: int):
+    """Time the cooldown check of posting, loading the posts vs max(date)."""
+
+    with session() as s:
+        q = s.query(PostOrmModel.ip4, PostOrmModel.thread_id, PostOrmModel.date)
+        q = q.order_by(PostOrmModel.id.desc()).limit(samples)
+        recent_posts = q.all()
+        s.commit()
+
+    if not recent_posts:
+        print("No posts found")
+        return
+
+    # The checks of a reply and of a new thread, as if posted right after the post
+    checks = []
+    for ip4, thread_id, date in recent_posts:
+        thread = ThreadModel()
+        thread.id = thread_id
+        reply_window = window or ban_service.NEW_POST_COOLDOWN
+        thread_window = window or ban_service.NEW_THREAD_COOLDOWN
+        checks.append((ip4, date - reply_window, thread))
+        checks.append((ip4, date - thread_window, None))
+
+    def find_posts(ip4, from_time, thread):
+        post_list = posts.find_posts_by_ip4_from_time(ip4, from_time, by_thread=thread)
+        return post_list[0].date if post_list else None
+
+    print(f"* {len(checks)} checks, {rounds} rounds")
+    print(f"{'method':<16}{'total ms':>12}{'per check ms':>14}")
+    results = {}
+    for name, find in [
+        ("load posts", find_posts),
+        ("max(date)", posts.find_last_post_date_by_ip4),
+    ]:
+        start_time = time.perf_counter()
+        for _ in range(rounds):
+            results[name] = list(map(lambda i: find(*i), checks))
+        total_time = (time.perf_counter() - start_time) * 1000 / rounds
+        print(f"{name:<16}{total_time:>12.2f}{total_time / len(checks):>14.3f}")
+
+    if results["load posts"] != results["max(date)"]:
+        print("! The methods found different dates")
+
+
+@app.cli.command("post-benchmark")
+@click.argument("board_name")
+@click.option("--writers", default="1,2,4,8", help="Numbers of concurrent writers.")
+@click.option("--replies", default=50, help="Number of replies per writer.")
+def post_benchmark(board_name: str, writers: str, replies: int):
+    """Time concurrent replies to one thread, in a new thread on a test board.
+
+    The thread is deleted afterwards, but it purges the last thread of a full board.
+    """
+
+    board = board_service.find_board(board_name)
+    if not board:
+        print("Board not found")
+        return
+
+    post = _benchmark_post("post-benchmark thread")
+    res, _, _ = posts.create_thread(board, post)
+    print(f"* /{board.name}/{res.thread_refno}, {replies} replies per writer")
+
+    print(f"{'writers':<10}{'posts/s':>10}{'db ms/post':>12}{'total ms/post':>15}")
+    try:
+        for writer_count in map(int, writers.split(",")):
+            pool = multiprocessing.get_context("fork").Pool(
+                writer_count, initializer=_warm_worker_init
+            )
+            jobs = [(board.name, res.thread_refno, replies)] * writer_count
+            start_time = time.perf_counter()
+            results = pool.map(_benchmark_replies, jobs)
+            wall_time = time.perf_counter() - start_time
+            pool.close()
+            pool.join()
+
+            post_count = writer_count * replies
+            insert_time = sum(map(lambda i: i[0], results)) / post_count
+            total_time = sum(map(lambda i: i[1], results)) / post_count
+            print(
+                f"{writer_count:<10}{post_count / wall_time:>10.1f}"
+                f"{insert_time:>12.2f}{total_time:>15.2f}"
+            )
+    finally:
+        thread = posts.find_thread_by_board_thread_refno_with_posts(
+            board, res.thread_refno
+        )
+        if thread:
+            posts.delete_thread(thread)
+
+
+def _benchmark_post(post_text: str):
+    post = PostModel()
+    post.date = now()
+    post.text = post_text
+    post.ip4 = 0x7F000001
+    return post
+
+
+def _benchmark_replies(args):
+    board_name, thread_refno, count = args
+    board = board_service.find_board(board_name)
+    thread = posts.find_thread_by_board_thread_refno_with_posts(board, thread_refno)
+
+    # Summed times of the transaction, and of the whole call with the cache updates
+    insert_time = 0
+    total_time = 0
+    for i in range(count):
+        start_time = time.perf_counter()
+        _, post_insert_time, _ = posts.create_post(
+            board, thread, _benchmark_post(f"post-benchmark reply {i}"), False
+        )
+        insert_time += post_insert_time
+        total_time += (time.perf_counter() - start_time) * 1000
+    return insert_time, total_time
+
+
+# The queries the indexes are made for, see docs/queries.rst
+QUERY_SHAPES = [
+    (
+        "thread by refno",
+        "SELECT * FROM thread WHERE board_id = :board_id AND refno = :thread_refno",
+    ),
+    (
+        "posts of a thread",
+        "SELECT * FROM post WHERE thread_id = :thread_id ORDER BY id",
+    ),
+    (
+        "threads to purge",
+        "SELECT * FROM thread WHERE board_id = :board_id "
+        "ORDER BY last_modified DESC OFFSET 100",
+    ),
+    (
+        "cooldown of a reply",
+        "SELECT max(date) FROM post WHERE ip4 = :ip4 AND date >= :from_time "
+        "AND thread_id = :thread_id",
+    ),
+    (
+        "cooldown of a new thread",
+        "SELECT max(date) FROM post WHERE ip4 = :ip4 AND date >= :from_time "
+        "AND refno = 1",
+    ),
+    (
+        "reports by date",
+        "SELECT * FROM report ORDER BY date DESC LIMIT 50",
+    ),
+    (
+        "mod log of a board",
+        "SELECT * FROM moderatorlog WHERE board_id = :board_id "
+        "ORDER BY date DESC LIMIT 50",
+    ),
+]
+
+
+@app.cli.command("explain-queries")
+def explain_queries():
+    """Print the plans of the hot queries on the largest board and thread."""
+
+    with get_sqlalchemy_engine().connect() as connection:
+        row = connection.execute(
+            text(
+                "SELECT thread.board_id, thread.id, thread.refno, post.ip4, post.date "
+                "FROM thread JOIN post ON post.thread_id = thread.id "
+                "ORDER BY thread.refno_counter DESC, post.id DESC LIMIT 1"
+            )
+        ).one_or_none()
+        if row is None:
+            print("No posts found")
+            return
+
+        params = {
+            "board_id": row[0],
+            "thread_id": row[1],
+            "thread_refno": row[2],
+            "ip4": row[3],
+            "from_time": row[4] - ban_service.NEW_THREAD_COOLDOWN,
+        }
+        for name, query in QUERY_SHAPES:
+            plan = connection.execute(
+                text("EXPLAIN (ANALYZE, BUFFERS) " + query), params
+            ).all()
+            print(f"* {name}")
+            for line in plan:
+                print("  " + line[0])
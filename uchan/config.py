@@ -25,6 +25,11 @@ class UchanConfig(BaseSettings):
     # Memcache server address
     memcached_host: str = ""
     memcached_port: int = 11211
+    # Where the caches are stored: "memcached", "redis", or "local" to keep them in
+    # the process itself, which only works with a single process.
+    cache_backend: Literal["memcached", "local", "redis"] = "memcached"
+    # Used with the redis cache backend, requires the redis package.
+    redis_url: str = "redis://localhost:6379/0"
 
     # Enable to purge the varnish cache
     varnish_enable_purging: bool = False
@@ -86,7 +91,63 @@ class UchanConfig(BaseSettings):
     # max_connections
     database_pool_size: int = 4
     database_echo_sql: bool = False
-
+    # Log a warning for requests that execute more SQL statements than this, 0 to
+    # disable. Pages served from the caches execute none.
+    database_request_statement_warning: int = 20
+
+    # Update the cached board pages and catalog per changed thread, instead of
+    # rebuilding all of them from every thread stub on each post.
+    board_index_incremental: bool = True
+
+    # Boards and threads decoded from memcache are kept in a bounded cache in every
+    # worker. Board models are checked against their version in memcache after
+    # local_cache_revalidate ms, thread models on every request.
+    local_cache_max_items: int = 1000
+    # 33554432 = 32 * 1024 * 1024
+    local_cache_max_bytes: int = 33554432
+    local_cache_revalidate: int = 1000
+    # Milliseconds to keep the site config, board names and pages locally. Changes
+    # reach all workers within local_cache_poll_interval ms regardless.
+    local_cache_timeout: int = 300000
+    local_cache_poll_interval: int = 1000
+
+    # Format of the values stored in memcache: "json", or "msgpack" when the msgpack
+    # package is installed. Use "legacy" during a rolling deploy from a version that
+    # can't read the format header yet. Values larger than cache_compress_threshold
+    # bytes are compressed with zlib, 0 disables compression.
+    cache_serializer: Literal["legacy", "json", "msgpack"] = "json"
+    cache_compress_threshold: int = 16384
+
+    # Milliseconds to collect changes to a board before the worker regenerates its pages
+    # and catalog, 0 to update them on every post. Threads are always updated right
+    # away. The regeneration rebuilds the pages fully, it replaces the incremental
+    # update of board_index_incremental and needs the Celery worker. Not used with
+    # bypass_worker.
+    board_regenerate_window: int = 0
+    # Count the hits, misses, sizes and round trip times of the cache per key family,
+    # served in the Prometheus text format on /api/metrics. Counted per process.
+    # The endpoint has no authentication, restrict access to it in your nginx config
+    # before enabling this.
+    cache_metrics: bool = False
+    # Seconds to remember that a board or thread does not exist, so that requests for
+    # them don't reach the database. 0 to disable.
+    negative_cache_timeout: int = 10
+    # Push new replies to the thread watchers with server-sent events, from
+    # /api/thread/<board>/<refno>/events. Every client holds a connection open, serve
+    # that endpoint from a gevent uwsgi, see docker/uwsgi.events.ini. The "postgres"
+    # broker passes the events between processes with LISTEN/NOTIFY, "local" only
+    # within one process.
+    thread_events: bool = False
+    thread_events_broker: Literal["local", "postgres"] = "postgres"
+    # Store gzip encodings, and brotli when the brotli package is installed, of the
+    # API documents and of the pages in the page cache, and send them by the
+    # Accept-Encoding of the request. Turn off compression in nginx for these.
+    precompress_documents: bool = True
+    # Keep the board, catalog and thread pages seen by anonymous users in the cache,
+    # for deployments without varnish in front. Outdated pages are served while one
+    # request renders the new version. Varnish purges don't clear it, leave it off
+    # when serving behind varnish.
+    page_cache: bool = False
     # The -I flag of memcache, the max size of items
     # note: "-I 2M" means "2 * 1024 * 1024" here
     # Memcache defaults to 1M
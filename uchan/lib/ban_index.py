@@ -0,0 +1,104 @@
+import ipaddress
+from bisect import bisect_right
+from typing import List, Optional, Tuple
+
+from uchan.lib.model import BanModel
+
+"""
+Lookup of the bans of an address in memory, over IPv4 and IPv6, so that checking a
+request for bans does not query the database.
+"""
+
+
+class BanIndex:
+    """
+    All bans, as ranges of addresses per address family. The ranges are cut into
+    segments that don't overlap, sorted by their first address. Every segment has the
+    bans that cover all of it, a lookup is a binary search for the segment.
+    """
+
+    def __init__(self, bans: List[BanModel]):
+        ranges = {4: [], 6: []}
+        for ban in bans:
+            ban_range = address_range(ban)
+            if ban_range is not None:
+                family, first, last = ban_range
+                ranges[family].append((first, last, ban))
+
+        self.ban_count = len(bans)
+        self.segments = {i: _build_segments(ranges[i]) for i in ranges}
+
+    def find(self, ip) -> List[BanModel]:
+        """
+        The bans that cover ip, an int for IPv4 or an address from the ipaddress module.
+        """
+        family, address = address_key(ip)
+        starts, ends, segment_bans = self.segments[family]
+        i = bisect_right(starts, address) - 1
+        if i < 0 or address > ends[i]:
+            return []
+        return list(segment_bans[i])
+
+
+def address_key(ip) -> Tuple[int, int]:
+    """
+    The address family and integer value of ip. IPv4 addresses mapped in IPv6 are
+    IPv4.
+    """
+    if isinstance(ip, int):
+        return 4, ip
+    if ip.version == 6 and ip.ipv4_mapped is not None:
+        return 4, int(ip.ipv4_mapped)
+    return ip.version, int(ip)
+
+
+def address_range(ban: BanModel) -> Optional[Tuple[int, int, int]]:
+    """
+    The address family and the first and last address that ban covers, or None when it
+    covers none.
+    """
+    if ban.ip6 is not None:
+        network = ipaddress.ip_network(ban.ip6, strict=False)
+        return (
+            network.version,
+            int(network.network_address),
+            int(network.broadcast_address),
+        )
+    if ban.ip4_end is not None:
+        # Range bans exclude both the start and the end address
+        if ban.ip4_end - ban.ip4 < 2:
+            return None
+        return 4, ban.ip4 + 1, ban.ip4_end - 1
+    return 4, ban.ip4, ban.ip4
+
+
+def _build_segments(ranges):
+    # Sweep over the boundaries of the ranges, with the bans active at each one.
+    events = []
+    for first, last, ban in ranges:
+        events.append((first, True, ban))
+        events.append((last + 1, False, ban))
+    events.sort(key=lambda i: i[0])
+
+    starts = []
+    ends = []
+    segment_bans = []
+    active = {}
+    i = 0
+    while i < len(events):
+        address = events[i][0]
+        while i < len(events) and events[i][0] == address:
+            _, added, ban = events[i]
+            if added:
+                active[id(ban)] = ban
+            else:
+                del active[id(ban)]
+            i += 1
+
+        if active:
+            starts.append(address)
+            # Ends where the next boundary is, there is one while bans are active
+            ends.append(events[i][0] - 1)
+            segment_bans.append(tuple(active.values()))
+
+    return starts, ends, segment_bans
@@ -0,0 +1,159 @@
+import json
+import logging
+import select
+from queue import Empty, Full, Queue
+from threading import Lock, Thread
+from time import sleep
+from typing import Optional
+
+from sqlalchemy import text
+
+from uchan import config
+from uchan.lib.database import get_sqlalchemy_engine
+
+"""
+Publish and subscribe of small text messages, used to push events to clients.
+Subscriptions wait on a queue in their own process, the broker delivers the messages
+published by all processes to them.
+"""
+
+logger = logging.getLogger(__name__)
+
+BROKER_LOCAL = "local"
+BROKER_POSTGRES = "postgres"
+
+# Messages for subscriptions that don't keep up are dropped
+SUBSCRIPTION_QUEUE_SIZE = 100
+
+POSTGRES_CHANNEL = "uchan_broker"
+# Seconds between the checks of the listening connection, and before reconnecting
+POSTGRES_LISTEN_TIMEOUT = 30
+POSTGRES_RECONNECT_DELAY = 5
+
+
+class Subscription:
+    def __init__(self, broker: "LocalBroker", channel: str):
+        self.broker = broker
+        self.channel = channel
+        self.queue = Queue(SUBSCRIPTION_QUEUE_SIZE)
+
+    def get(self, timeout) -> Optional[str]:
+        """
+        Wait at most timeout seconds for a message. Returns None when there was none.
+        """
+        try:
+            return self.queue.get(timeout=timeout)
+        except Empty:
+            return None
+
+    def close(self):
+        self.broker.unsubscribe(self)
+
+    def deliver(self, message: str):
+        try:
+            self.queue.put_nowait(message)
+        except Full:
+            pass
+
+
+class LocalBroker:
+    """
+    Delivers the messages to the subscriptions of this process only. For development,
+    or when posts are made in the same process as the subscriptions.
+    """
+
+    def __init__(self):
+        self.lock = Lock()
+        # channel -> set of Subscription
+        self.subscriptions = {}
+
+    def publish(self, channel: str, message: str):
+        self.deliver(channel, message)
+
+    def subscribe(self, channel: str) -> Subscription:
+        subscription = Subscription(self, channel)
+        with self.lock:
+            self.subscriptions.setdefault(channel, set()).add(subscription)
+        return subscription
+
+    def unsubscribe(self, subscription: Subscription):
+        with self.lock:
+            subscriptions = self.subscriptions.get(subscription.channel)
+            if subscriptions is not None:
+                subscriptions.discard(subscription)
+                if not subscriptions:
+                    del self.subscriptions[subscription.channel]
+
+    def deliver(self, channel: str, message: str):
+        with self.lock:
+            subscriptions = list(self.subscriptions.get(channel, ()))
+        for subscription in subscriptions:
+            subscription.deliver(message)
+
+
+class PostgresBroker(LocalBroker):
+    """
+    Publishes with Postgres NOTIFY. Every process with subscriptions has one connection
+    that LISTENs, in a thread that is started on the first subscription. Uwsgi runs
+    that thread only with enable-threads or gevent.
+    """
+
+    def __init__(self):
+        super().__init__()
+        self.listener: Thread = None
+
+    def publish(self, channel: str, message: str):
+        payload = json.dumps([channel, message])
+        with get_sqlalchemy_engine().begin() as connection:
+            connection.execute(
+                text("SELECT pg_notify(:channel, :payload)"),
+                {"channel": POSTGRES_CHANNEL, "payload": payload},
+            )
+
+    def subscribe(self, channel: str) -> Subscription:
+        with self.lock:
+            if self.listener is None:
+                self.listener = Thread(target=self._listen, daemon=True)
+                self.listener.start()
+        return super().subscribe(channel)
+
+    def _listen(self):
+        while True:
+            try:
+                self._listen_connection()
+            except Exception:
+                logger.exception("broker listen connection failed")
+            sleep(POSTGRES_RECONNECT_DELAY)
+
+    def _listen_connection(self):
+        # Not returned to the pool, it is closed when it fails
+        pool_connection = get_sqlalchemy_engine().raw_connection()
+        try:
+            connection = pool_connection.driver_connection
+            connection.autocommit = True
+            connection.cursor().execute("LISTEN " + POSTGRES_CHANNEL)
+
+            while True:
+                readable, _, _ = select.select(
+                    [connection], [], [], POSTGRES_LISTEN_TIMEOUT
+                )
+                if not readable:
+                    continue
+
+                connection.poll()
+                while connection.notifies:
+                    notify = connection.notifies.pop(0)
+                    channel, message = json.loads(notify.payload)
+                    self.deliver(channel, message)
+        finally:
+            pool_connection.invalidate()
+
+
+def _create_broker():
+    if config.thread_events_broker == BROKER_LOCAL:
+        return LocalBroker()
+    else:
+        return PostgresBroker()
+
+
+broker = _create_broker()
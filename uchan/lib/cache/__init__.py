@@ -1,14 +1,31 @@
-import json
 import logging
-from time import time
-
-from cachelib.memcached import MemcachedCache
+from collections import OrderedDict
+from contextlib import contextmanager
+from threading import Lock
+from time import perf_counter, sleep
+from uuid import uuid4
 
 from uchan import config
+from uchan.lib.cache.backend import (
+    BACKEND_LOCAL,
+    BACKEND_REDIS,
+    CacheBackend,
+    LocalBackend,
+    MemcachedBackend,
+    RedisBackend,
+)
+from uchan.lib.cache.codec import CacheCodec
+from uchan.lib.cache.metrics import CacheMetrics
 from uchan.lib.utils import now
 
 logger = logging.getLogger(__name__)
 
+# Seconds after which a rebuild lock expires, in case the worker holding it died
+REBUILD_LOCK_TIMEOUT = 10
+# Milliseconds to wait for another worker to finish a rebuild
+REBUILD_WAIT_TIMEOUT = 3000
+REBUILD_POLL_INTERVAL = 25
+
 
 def make_attr_dict(value):
     if isinstance(value, list):
@@ -21,26 +38,219 @@ def make_attr_dict(value):
     return value
 
 
-class CacheWrapper(MemcachedCache):
-    def __init__(self, server, max_item_size):
-        super().__init__([server])
-        self.client = self._client
-        self.client.server_max_value_length = self.max_length = max_item_size
+class CacheWrapper:
+    def __init__(
+        self,
+        backend: CacheBackend,
+        max_item_size,
+        codec: CacheCodec,
+        metrics: CacheMetrics = None,
+    ):
+        self.backend = backend
+        self.max_length = max_item_size
+        self.codec = codec
+        self.metrics = metrics
+
+    def reconnect(self):
+        """
+        Use new connections to the backend, the clients can't be shared with a forked
+        process.
+        """
+        self.backend.reconnect()
 
-    def set(self, key, value, **kwargs):
+    def get_stats(self):
+        return self.backend.get_stats()
+
+    def set(self, key, value, timeout=None):
         # g.logger.debug('set {} {}'.format(key, value))
 
-        json_data = json.dumps(value, separators=(",", ":"))
+        data = self._dumps(key, value)
+        if data is None:
+            return False
+
+        start = perf_counter()
+        ret = self.backend.set(key, data, timeout=timeout)
+        self._observe_write("set", [key], start, [data])
+        if not ret:
+            logger.error("cache set failed {}".format(ret))
+        return ret
+
+    def add(self, key, value, timeout=None):
+        """
+        Set the value only when the key does not exist yet. Returns True if it was set.
+        """
+        data = self._dumps(key, value)
+        if data is None:
+            return False
+
+        start = perf_counter()
+        ret = self.backend.add(key, data, timeout=timeout)
+        self._observe_write("add", [key], start, [data])
+        return ret
+
+    def set_raw(self, key, data: bytes, timeout=None):
+        """
+        Set data as it is, without encoding it. For values that are served as they are,
+        read them with get_raw.
+        """
+        if not self._check_length(key, data):
+            return False
+
+        start = perf_counter()
+        ret = self.backend.set(key, data, timeout=timeout)
+        self._observe_write("set", [key], start, [data])
+        if not ret:
+            logger.error("cache set failed {}".format(ret))
+        return ret
+
+    def add_raw(self, key, data: bytes, timeout=None):
+        if not self._check_length(key, data):
+            return False
+
+        start = perf_counter()
+        ret = self.backend.add(key, data, timeout=timeout)
+        self._observe_write("add", [key], start, [data])
+        return ret
 
-        if len(json_data) > self.max_length:
+    def set_many(self, mapping, timeout=None, raw_mapping=None):
+        """
+        Set all the key values of mapping in one round trip. Values that are too large
+        are skipped. raw_mapping is set along with it, without encoding, see set_raw.
+        Returns a list of the keys that were set.
+        """
+        data_mapping = {}
+        for key, value in mapping.items():
+            data = self._dumps(key, value)
+            if data is not None:
+                data_mapping[key] = data
+        if raw_mapping:
+            for key, data in raw_mapping.items():
+                if self._check_length(key, data):
+                    data_mapping[key] = data
+
+        if not data_mapping:
+            return []
+
+        start = perf_counter()
+        set_keys = self.backend.set_many(data_mapping, timeout=timeout)
+        self._observe_write(
+            "set_many", list(data_mapping), start, list(data_mapping.values())
+        )
+        if len(set_keys) != len(data_mapping):
+            logger.error(
+                "cache set_many failed for {}".format(
+                    [i for i in data_mapping if i not in set_keys]
+                )
+            )
+        return set_keys
+
+    def get(self, key, convert=False):
+        # g.logger.debug('get {}'.format(key))
+        start = perf_counter()
+        res = self.backend.get(key)
+        self._observe_read("get", [key], start, [res])
+        if res is None:
+            return None
+        else:
+            return self._loads(res, convert)
+
+    def get_raw(self, key):
+        """
+        Get the data set with set_raw, None when it is missing.
+        """
+        start = perf_counter()
+        res = self.backend.get(key)
+        self._observe_read("get", [key], start, [res])
+        return res
+
+    def get_sized(self, key, convert=False):
+        """
+        Like get, but returns a tuple of the value and the length of the stored data.
+        """
+        start = perf_counter()
+        res = self.backend.get(key)
+        self._observe_read("get", [key], start, [res])
+        if res is None:
+            return None, 0
+        else:
+            return self._loads(res, convert), len(res)
+
+    def get_many(self, *keys, convert=False):
+        """
+        Get the values of all keys in one round trip. Returns a list in the same order
+        as keys, with None for missing keys.
+        """
+        return list(map(lambda i: i[0], self.get_many_sized(*keys, convert=convert)))
+
+    def get_many_sized(self, *keys, convert=False):
+        """
+        Like get_many, but returns a list of tuples of the value and the length of the
+        stored data.
+        """
+        if not keys:
+            return []
+
+        start = perf_counter()
+        res = self.backend.get_many(keys)
+        values = list(map(res.get, keys))
+        self._observe_read("get_many", keys, start, values)
+        return list(
+            map(
+                lambda i: (None, 0) if i is None else (self._loads(i, convert), len(i)),
+                values,
+            )
+        )
+
+    def delete(self, key):
+        # logger.debug('delete {}'.format(key))
+        start = perf_counter()
+        self.backend.delete(key)
+        self._observe("delete", [key], start)
+
+    def delete_many(self, *keys):
+        if not keys:
+            return
+        start = perf_counter()
+        self.backend.delete_many(keys)
+        self._observe("delete_many", keys, start)
+
+    def ordered_set_get(self, key):
+        """
+        Get all members of an ordered set with their scores, see CacheBackend. Returns
+        None when the set does not exist.
+        """
+        start = perf_counter()
+        res = self.backend.ordered_set_get(key)
+        self._observe("ordered_set_get", [key], start)
+        return res
+
+    def ordered_set_replace(self, key, items):
+        start = perf_counter()
+        self.backend.ordered_set_replace(key, items)
+        self._observe("ordered_set_replace", [key], start)
+
+    def ordered_set_update(self, key, added, removed):
+        start = perf_counter()
+        res = self.backend.ordered_set_update(key, added, removed)
+        self._observe("ordered_set_update", [key], start)
+        return res
+
+    def _dumps(self, key, value):
+        data = self.codec.encode(value)
+        if not self._check_length(key, data):
+            return None
+        return data
+
+    def _check_length(self, key, data):
+        if len(data) > self.max_length:
             logger.error(
                 "cache value exceeds max length ({} > {})".format(
-                    len(json_data), self.max_length
+                    len(data), self.max_length
                 )
             )
             return False
 
-        percentage = len(json_data) / self.max_length
+        percentage = len(data) / self.max_length
         if percentage > 0.5:
             logger.warning(
                 "key {0} exceeds 50% of the total storage available ({1:.2f}%)".format(
@@ -48,34 +258,26 @@ class CacheWrapper(MemcachedCache):
                 )
             )
 
-        ret = super().set(key, json_data, **kwargs)
-        if not ret:
-            logger.error("cache set failed {}".format(ret))
-        return bool(ret)
+        return True
 
-    def get(self, key, convert=False):
-        # g.logger.debug('get {}'.format(key))
-        res = super().get(key)
-        if res is None:
-            return None
-        else:
-            data = json.loads(res)
-            if convert:
-                return make_attr_dict(data)
-            else:
-                return data
+    def _observe_read(self, op, keys, start, values):
+        if self.metrics:
+            self.metrics.observe_read(op, keys, perf_counter() - start, values)
 
-    def delete(self, key):
-        # logger.debug('delete {}'.format(key))
-        super().delete(key)
+    def _observe_write(self, op, keys, start, values):
+        if self.metrics:
+            self.metrics.observe_write(op, keys, perf_counter() - start, values)
 
-    def _normalize_timeout(self, timeout):
-        if timeout is None:
-            return self.default_timeout
-        # Allow zero to mean the same as does not expire
-        if timeout == 0:
-            return 0
-        return int(time()) + timeout
+    def _observe(self, op, keys, start):
+        if self.metrics:
+            self.metrics.observe(op, keys, perf_counter() - start)
+
+    def _loads(self, res, convert):
+        data = self.codec.decode(res)
+        if convert:
+            return make_attr_dict(data)
+        else:
+            return data
 
 
 def cache_key(*args):
@@ -101,26 +303,311 @@ class CacheDict(dict):
 
 class LocalCache:
     """
-    Super simple local cache with no pruning based on a dict.
-    Don't do anything special.
+    Simple local cache based on an ordered dict. Items expire after their timeout, and
+    the least recently used items are pruned when there are more than max_items items,
+    or when the sizes given with set add up to more than max_bytes.
+    Caches with a namespace are cleared in all workers when one of them calls
+    invalidate, see LocalCacheChannel.
     """
 
-    def __init__(self):
-        self.items = {}
+    def __init__(self, max_items=1000, max_bytes=0, namespace=None, timeout=15000):
+        self.items = OrderedDict()
+        self.max_items = max_items
+        self.max_bytes = max_bytes
+        self.total_bytes = 0
+        self.lock = Lock()
+        self.namespace = namespace
+        self.timeout = timeout
+        if namespace is not None:
+            local_cache_channel.register(namespace, self)
+
+    def set(self, key, value, timeout=None, size=0):
+        if timeout is None:
+            timeout = self.timeout
+        with self.lock:
+            self._remove(key)
+            self.items[key] = (now() + timeout, size, value)
+            self.total_bytes += size
 
-    def set(self, key, value, timeout=15000):
-        self.items[key] = (now() + timeout, value)
+            while len(self.items) > self.max_items or (
+                self.max_bytes and self.total_bytes > self.max_bytes
+            ):
+                _, (_, pruned_size, _) = self.items.popitem(last=False)
+                self.total_bytes -= pruned_size
 
     def get(self, key):
-        try:
-            expires, item = self.items[key]
+        if self.namespace is not None:
+            local_cache_channel.poll()
+
+        with self.lock:
+            try:
+                expires, size, item = self.items[key]
+            except KeyError:
+                return None
+
             if now() < expires:
+                self.items.move_to_end(key)
                 return item
-        except KeyError:
-            pass
-        return None
+
+            self._remove(key)
+            return None
+
+    def delete(self, key):
+        with self.lock:
+            self._remove(key)
+
+    def clear(self):
+        with self.lock:
+            self.items.clear()
+            self.total_bytes = 0
+
+    def invalidate(self):
+        """
+        Clear this cache in all workers, in others within the poll interval.
+        """
+        if self.namespace is not None:
+            local_cache_channel.invalidate(self.namespace)
+        else:
+            self.clear()
+
+    def _remove(self, key):
+        existing = self.items.pop(key, None)
+        if existing is not None:
+            self.total_bytes -= existing[1]
+
+
+class LocalCacheChannel:
+    """
+    Tells the local caches of all workers to clear themselves, with a version key per
+    namespace in memcache. The versions of all namespaces are polled together with one
+    get_many, at most every poll_interval ms.
+    """
+
+    def __init__(self, shared: CacheWrapper, poll_interval=1000):
+        self.shared = shared
+        self.poll_interval = poll_interval
+        self.caches = {}
+        self.versions = {}
+        self.poll_at = 0
+        self.lock = Lock()
+
+    def register(self, namespace, local_cache: LocalCache):
+        self.caches[namespace] = local_cache
+
+    def poll(self):
+        if now() < self.poll_at:
+            return
+        with self.lock:
+            if now() < self.poll_at:
+                return
+            self.poll_at = now() + self.poll_interval
+
+        namespaces = list(self.caches)
+        versions = self.shared.get_many(*map(self._version_key, namespaces))
+        for namespace, version in zip(namespaces, versions, strict=True):
+            if namespace not in self.versions:
+                # First poll of this worker, nothing cached yet.
+                self.versions[namespace] = version
+            elif version != self.versions[namespace]:
+                # Also clears when memcache lost the version.
+                self.versions[namespace] = version
+                self.caches[namespace].clear()
+
+    def version_tag(self):
+        """
+        A tag of the current versions of all namespaces, it changes when any of the
+        local caches is invalidated.
+        """
+        self.poll()
+        return ",".join(
+            map(lambda i: "{}={}".format(i, self.versions.get(i)), sorted(self.caches))
+        )
+
+    def invalidate(self, namespace):
+        version = uuid4().hex
+        self.shared.set(self._version_key(namespace), version, timeout=0)
+        self.versions[namespace] = version
+        self.caches[namespace].clear()
+
+    def _version_key(self, namespace):
+        return "version$local:" + namespace
+
+
+class _ModelCacheEntry:
+    __slots__ = ("version", "revalidate_at", "model")
+
+    def __init__(self, version, revalidate_at, model):
+        self.version = version
+        self.revalidate_at = revalidate_at
+        self.model = model
+
+
+class ModelCache:
+    """
+    Keeps decoded models of shared cache keys in a LocalCache of this worker.
+
+    Each key has a version key in the shared cache that changes on every write, see
+    invalidate. A local model is returned without any round trip for
+    revalidate_timeout ms, after that it is returned only if the version is unchanged.
+    The models are shared between requests and must not be modified.
+    """
+
+    def __init__(
+        self,
+        shared: CacheWrapper,
+        max_items=1000,
+        max_bytes=0,
+        revalidate_timeout=1000,
+        timeout=60000,
+    ):
+        self.shared = shared
+        self.local = LocalCache(max_items, max_bytes)
+        self.revalidate_timeout = revalidate_timeout
+        self.timeout = timeout
+
+    def get(self, key, load):
+        """
+        Get the model for key. load is called when there is no valid local model, and
+        should return a tuple of the model and its size in bytes, or None. Models with a
+        size of None are not kept locally.
+        """
+        entry = self.local.get(key)
+        if entry is not None and now() < entry.revalidate_at:
+            return entry.model
+
+        # Read the version before loading, a write in between then makes the version
+        # mismatch on the next revalidation.
+        version_key = self._version_key(key)
+        version = self.shared.get(version_key)
+        if entry is not None and version is not None and version == entry.version:
+            entry.revalidate_at = now() + self.revalidate_timeout
+            return entry.model
+
+        loaded = load()
+        if loaded is None:
+            self.local.delete(key)
+            return None
+
+        model, size = loaded
+        # Only create versions for existing models, lookups of missing ones don't write.
+        if version is None and size is not None:
+            version = uuid4().hex
+            if not self.shared.add(version_key, version, timeout=0):
+                # Written by someone else in the meantime, don't keep it locally.
+                version = None
+        if version is not None and size is not None:
+            entry = _ModelCacheEntry(version, now() + self.revalidate_timeout, model)
+            self.local.set(key, entry, timeout=self.timeout, size=size)
+        else:
+            self.local.delete(key)
+        return model
+
+    def get_version(self, key):
+        """
+        Get the current version of key, None when it has none yet. The version is
+        changed after every write, data read after reading the version is at least as
+        new as the version.
+        """
+        return self.shared.get(self._version_key(key))
+
+    def invalidate(self, *keys):
+        """
+        Call after writing or deleting keys in the shared cache, to make all workers
+        drop their local models.
+        """
+        versions = {}
+        for key in keys:
+            versions[self._version_key(key)] = uuid4().hex
+            self.local.delete(key)
+        self.shared.set_many(versions, timeout=0)
+
+    def _version_key(self, key):
+        return "version$" + key
+
+
+def rebuild_once(key, load, rebuild):
+    """
+    Rebuild a missing cache key in only one worker at a time.
+    The worker that gets the lock for the key calls rebuild, other workers poll load
+    until the key is available. They call rebuild themselves when the lock was released
+    without the key being set, or when waiting takes too long.
+    load should return None when the key is still missing.
+    """
+    lock_key = "lock$" + key
+    if cache.add(lock_key, True, timeout=REBUILD_LOCK_TIMEOUT):
+        try:
+            return rebuild()
+        finally:
+            cache.delete(lock_key)
+
+    wait_until = now() + REBUILD_WAIT_TIMEOUT
+    while now() < wait_until:
+        sleep(REBUILD_POLL_INTERVAL / 1000)
+        res = load()
+        if res is not None:
+            return res
+        if cache.get(lock_key) is None:
+            break
+
+    return rebuild()
+
+
+def missing_key(key):
+    return "missing$" + key
+
+
+def set_missing(key):
+    """
+    Remember that the model for key does not exist, for negative_cache_timeout seconds.
+    Lookups check the key itself first, so that a model created in the meantime is
+    found even when this is set late.
+    """
+    if config.negative_cache_timeout > 0:
+        cache.set(missing_key(key), True, timeout=config.negative_cache_timeout)
+
+
+@contextmanager
+def cache_lock(key):
+    """
+    Hold the lock for key while updating its cache, shared with rebuild_once.
+    When the lock is still taken after waiting, continue without it. The update
+    should then verify what it read, like a late rebuild would.
+    Yields whether the lock was acquired.
+    """
+    lock_key = "lock$" + key
+    acquired = cache.add(lock_key, True, timeout=REBUILD_LOCK_TIMEOUT)
+    wait_until = now() + REBUILD_WAIT_TIMEOUT
+    while not acquired and now() < wait_until:
+        sleep(REBUILD_POLL_INTERVAL / 1000)
+        acquired = cache.add(lock_key, True, timeout=REBUILD_LOCK_TIMEOUT)
+
+    if not acquired:
+        logger.warning("continuing without lock for {}".format(key))
+
+    try:
+        yield acquired
+    finally:
+        if acquired:
+            cache.delete(lock_key)
+
+
+def _create_backend() -> CacheBackend:
+    if config.cache_backend == BACKEND_LOCAL:
+        return LocalBackend()
+    elif config.cache_backend == BACKEND_REDIS:
+        return RedisBackend(config.redis_url)
+    else:
+        return MemcachedBackend(
+            f"{config.memcached_host}:{config.memcached_port}",
+            config.memcache_max_item_size,
+        )
 
 
 cache = CacheWrapper(
-    f"{config.memcached_host}:{config.memcached_port}", config.memcache_max_item_size
+    _create_backend(),
+    config.memcache_max_item_size,
+    CacheCodec(config.cache_serializer, config.cache_compress_threshold),
+    CacheMetrics() if config.cache_metrics else None,
 )
+
+local_cache_channel = LocalCacheChannel(cache, config.local_cache_poll_interval)
@@ -0,0 +1,386 @@
+import json
+from collections import OrderedDict
+from threading import Lock
+from time import time
+
+from cachelib.memcached import MemcachedCache
+
+try:
+    import redis
+except ImportError:
+    redis = None
+
+"""
+Storage of the cache values. CacheWrapper encodes the values and counts the round trips,
+the backends store the encoded data.
+Timeouts are in seconds, 0 never expires and None uses DEFAULT_TIMEOUT.
+"""
+
+DEFAULT_TIMEOUT = 300
+
+BACKEND_MEMCACHED = "memcached"
+BACKEND_LOCAL = "local"
+BACKEND_REDIS = "redis"
+
+# Times to read and write an ordered set when other updates keep changing it
+ORDERED_SET_UPDATE_ATTEMPTS = 5
+
+
+class CacheBackend:
+    """
+    Interface of the cache backends.
+    Ordered sets keep members sorted by score, and then by member, like a Redis sorted
+    set. They are implemented here as a sorted list stored as a normal value. Backends
+    with native sorted sets override these methods.
+    """
+
+    def get(self, key):
+        raise NotImplementedError()
+
+    def get_many(self, keys):
+        """
+        Returns a dict with the data of the keys that exist.
+        """
+        raise NotImplementedError()
+
+    def set(self, key, data, timeout=None) -> bool:
+        raise NotImplementedError()
+
+    def set_many(self, mapping, timeout=None):
+        """
+        Returns a list of the keys that were set.
+        """
+        raise NotImplementedError()
+
+    def add(self, key, data, timeout=None) -> bool:
+        raise NotImplementedError()
+
+    def delete(self, key):
+        raise NotImplementedError()
+
+    def delete_many(self, keys):
+        raise NotImplementedError()
+
+    def reconnect(self):
+        """
+        Use new connections, for use after forking.
+        """
+        pass
+
+    def get_stats(self):
+        """
+        Returns a list of tuples of the server name and a dict of statistics.
+        """
+        return []
+
+    def gets(self, key):
+        """
+        Get the data of key with a token for cas. Returns a tuple of None and None when
+        the key does not exist.
+        """
+        raise NotImplementedError()
+
+    def cas(self, key, data, token, timeout=None) -> bool:
+        """
+        Set key only when it was not changed since the gets that returned token.
+        Returns whether it was set.
+        """
+        raise NotImplementedError()
+
+    def ordered_set_get(self, key):
+        """
+        Get all members of the ordered set with their score, in order. Returns None when
+        the set does not exist.
+        """
+        data = self.get(key)
+        if data is None:
+            return None
+        return _decode_ordered_set(data)
+
+    def ordered_set_replace(self, key, items):
+        """
+        Replace the ordered set with items, a list of tuples of member and score.
+        """
+        self.set(key, _encode_ordered_set(items), timeout=0)
+
+    def ordered_set_update(self, key, added, removed) -> bool:
+        """
+        Add the members of added, a dict of member to score, or move them when they
+        exist, and remove the members in removed. Does nothing when the set does not
+        exist. Returns whether the set was updated.
+        This implementation reads and writes the whole set with gets and cas, and reads
+        it again when another update changed it in between. When that keeps happening
+        the set is deleted and False is returned, the caller then rebuilds it.
+        """
+        for _ in range(ORDERED_SET_UPDATE_ATTEMPTS):
+            data, token = self.gets(key)
+            if data is None:
+                return False
+
+            items = _update_ordered_set(_decode_ordered_set(data), added, removed)
+            if self.cas(key, _encode_ordered_set(items), token, timeout=0):
+                return True
+
+        self.delete(key)
+        return False
+
+
+class _MemcachedCache(MemcachedCache):
+    def _normalize_timeout(self, timeout):
+        if timeout is None:
+            return self.default_timeout
+        # Allow zero to mean the same as does not expire
+        if timeout == 0:
+            return 0
+        return int(time()) + timeout
+
+
+class MemcachedBackend(CacheBackend):
+    def __init__(self, server, max_item_size):
+        self.memcached = _MemcachedCache([server], default_timeout=DEFAULT_TIMEOUT)
+        self.memcached._client.server_max_value_length = max_item_size
+        # pylibmc only returns the cas tokens with this behavior
+        self.memcached._client.behaviors = {"cas": True}
+
+    def get(self, key):
+        return self.memcached.get(key)
+
+    def get_many(self, keys):
+        res = self.memcached.get_dict(*keys)
+        return {k: v for k, v in res.items() if v is not None}
+
+    def set(self, key, data, timeout=None):
+        return bool(self.memcached.set(key, data, timeout=timeout))
+
+    def set_many(self, mapping, timeout=None):
+        return self.memcached.set_many(mapping, timeout=timeout)
+
+    def add(self, key, data, timeout=None):
+        return self.memcached.add(key, data, timeout=timeout)
+
+    def delete(self, key):
+        self.memcached.delete(key)
+
+    def gets(self, key):
+        return self.memcached._client.gets(self.memcached._normalize_key(key))
+
+    def cas(self, key, data, token, timeout=None):
+        return bool(
+            self.memcached._client.cas(
+                self.memcached._normalize_key(key),
+                data,
+                token,
+                self.memcached._normalize_timeout(timeout),
+            )
+        )
+
+    def delete_many(self, keys):
+        # Don't use the cachelib implementation, it checks every key afterwards.
+        self.memcached._client.delete_multi(
+            list(map(lambda i: self.memcached._normalize_key(i), keys))
+        )
+
+    def reconnect(self):
+        self.memcached._client = self.memcached._client.clone()
+
+    def get_stats(self):
+        return list(
+            map(
+                lambda i: (i[0].decode("utf8"), i[1]),
+                self.memcached._client.get_stats(),
+            )
+        )
+
+
+class LocalBackend(CacheBackend):
+    """
+    Dict in the current process, for tests and benchmarks, and for deployments with a
+    single process. Every process has its own, it can't be used with several workers.
+    The least recently used keys are pruned when there are more than max_items.
+    """
+
+    def __init__(self, max_items=100000):
+        self.items = OrderedDict()
+        self.max_items = max_items
+        self.lock = Lock()
+
+    def get(self, key):
+        with self.lock:
+            return self._get(key)
+
+    def get_many(self, keys):
+        res = {}
+        with self.lock:
+            for key in keys:
+                data = self._get(key)
+                if data is not None:
+                    res[key] = data
+        return res
+
+    def set(self, key, data, timeout=None):
+        with self.lock:
+            self._set(key, data, timeout)
+        return True
+
+    def set_many(self, mapping, timeout=None):
+        with self.lock:
+            for key, data in mapping.items():
+                self._set(key, data, timeout)
+        return list(mapping)
+
+    def add(self, key, data, timeout=None):
+        with self.lock:
+            if self._get(key) is not None:
+                return False
+            self._set(key, data, timeout)
+            return True
+
+    def delete(self, key):
+        with self.lock:
+            self.items.pop(key, None)
+
+    def delete_many(self, keys):
+        with self.lock:
+            for key in keys:
+                self.items.pop(key, None)
+
+    def get_stats(self):
+        return [("local", {"items": len(self.items), "max_items": self.max_items})]
+
+    def ordered_set_update(self, key, added, removed):
+        # The lock is held for the whole update, no compare-and-set needed
+        with self.lock:
+            data = self._get(key)
+            if data is None:
+                return False
+
+            items = _update_ordered_set(_decode_ordered_set(data), added, removed)
+            self._set(key, _encode_ordered_set(items), 0)
+            return True
+
+    def _get(self, key):
+        item = self.items.get(key)
+        if item is None:
+            return None
+
+        expires, data = item
+        if expires and expires < time():
+            del self.items[key]
+            return None
+
+        self.items.move_to_end(key)
+        return data
+
+    def _set(self, key, data, timeout):
+        if timeout is None:
+            timeout = DEFAULT_TIMEOUT
+        self.items.pop(key, None)
+        self.items[key] = (time() + timeout if timeout else 0, data)
+        while len(self.items) > self.max_items:
+            self.items.popitem(last=False)
+
+
+# Only update sets that exist, a new partial set would look complete.
+_REDIS_ORDERED_SET_UPDATE = """
+if redis.call("exists", KEYS[1]) == 0 then
+    return 0
+end
+if #ARGV > 1 then
+    redis.call("zrem", KEYS[1], unpack(ARGV, 2))
+end
+local added = cjson.decode(ARGV[1])
+for i = 1, #added do
+    redis.call("zadd", KEYS[1], added[i][2], added[i][1])
+end
+return 1
+"""
+
+
+class RedisBackend(CacheBackend):
+    """
+    Redis backend, ordered sets are native sorted sets. Requires the redis package.
+    """
+
+    def __init__(self, url):
+        if redis is None:
+            raise Exception("The redis cache backend requires the redis package")
+
+        self.url = url
+        self.reconnect()
+
+    def get(self, key):
+        return self.client.get(key)
+
+    def get_many(self, keys):
+        values = self.client.mget(keys)
+        return {k: v for k, v in zip(keys, values, strict=True) if v is not None}
+
+    def set(self, key, data, timeout=None):
+        return bool(self.client.set(key, data, ex=self._expire(timeout)))
+
+    def set_many(self, mapping, timeout=None):
+        pipeline = self.client.pipeline(transaction=False)
+        for key, data in mapping.items():
+            pipeline.set(key, data, ex=self._expire(timeout))
+        results = pipeline.execute()
+        return [k for k, res in zip(mapping, results, strict=True) if res]
+
+    def add(self, key, data, timeout=None):
+        return bool(self.client.set(key, data, ex=self._expire(timeout), nx=True))
+
+    def delete(self, key):
+        self.client.delete(key)
+
+    def delete_many(self, keys):
+        self.client.delete(*keys)
+
+    def reconnect(self):
+        self.client = redis.Redis.from_url(self.url)
+        self._ordered_set_update_script = self.client.register_script(
+            _REDIS_ORDERED_SET_UPDATE
+        )
+
+    def get_stats(self):
+        return [(self.url, self.client.info())]
+
+    def ordered_set_get(self, key):
+        items = self.client.zrange(key, 0, -1, withscores=True)
+        # Empty sorted sets don't exist in Redis
+        if not items:
+            return None
+        return list(map(lambda i: (i[0].decode("utf8"), i[1]), items))
+
+    def ordered_set_replace(self, key, items):
+        pipeline = self.client.pipeline(transaction=True)
+        pipeline.delete(key)
+        if items:
+            pipeline.zadd(key, dict(items))
+        pipeline.execute()
+
+    def ordered_set_update(self, key, added, removed):
+        added = json.dumps(list(map(list, added.items())))
+        return bool(self._ordered_set_update_script(keys=[key], args=[added, *removed]))
+
+    def _expire(self, timeout):
+        if timeout is None:
+            return DEFAULT_TIMEOUT
+        # No expiry for 0
+        return timeout or None
+
+
+def _ordered_set_sort_key(item):
+    return item[1], item[0]
+
+
+def _decode_ordered_set(data):
+    return list(map(lambda i: (i[0], i[1]), json.loads(data)))
+
+
+def _encode_ordered_set(items):
+    items = sorted(items, key=_ordered_set_sort_key)
+    return json.dumps(items, separators=(",", ":")).encode()
+
+
+def _update_ordered_set(items, added, removed):
+    changed = set(added) | set(removed)
+    return [i for i in items if i[0] not in changed] + list(added.items())
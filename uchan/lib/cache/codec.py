@@ -0,0 +1,76 @@
+import json
+import zlib
+
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+"""
+Encoding of the values stored in the cache.
+Values start with a format header byte, so that entries of different formats can be
+read side by side. Values without a header are plain JSON text, as written by versions
+without the header and by the legacy serializer.
+"""
+
+FORMAT_JSON = 1
+FORMAT_JSON_ZLIB = 2
+FORMAT_MSGPACK = 3
+FORMAT_MSGPACK_ZLIB = 4
+
+SERIALIZER_LEGACY = "legacy"
+SERIALIZER_JSON = "json"
+SERIALIZER_MSGPACK = "msgpack"
+
+
+class CacheCodec:
+    def __init__(self, serializer=SERIALIZER_JSON, compress_threshold=0, level=1):
+        if serializer == SERIALIZER_MSGPACK and msgpack is None:
+            raise Exception("The msgpack serializer requires the msgpack package")
+
+        self.serializer = serializer
+        # Compress values larger than this many bytes, 0 to disable compression
+        self.compress_threshold = compress_threshold
+        self.level = level
+
+    def encode(self, value):
+        if self.serializer == SERIALIZER_LEGACY:
+            return json.dumps(value, separators=(",", ":"))
+
+        if self.serializer == SERIALIZER_MSGPACK:
+            data = msgpack.packb(value, use_bin_type=True)
+            data_format = FORMAT_MSGPACK
+        else:
+            data = json.dumps(value, separators=(",", ":")).encode()
+            data_format = FORMAT_JSON
+
+        if self.compress_threshold and len(data) > self.compress_threshold:
+            compressed = zlib.compress(data, self.level)
+            # Only keep it when it actually got smaller
+            if len(compressed) < len(data):
+                data = compressed
+                data_format += 1
+
+        return bytes((data_format,)) + data
+
+    def decode(self, data):
+        if isinstance(data, str):
+            return json.loads(data)
+
+        data_format = data[0]
+        if data_format == FORMAT_JSON:
+            return json.loads(data[1:])
+        elif data_format == FORMAT_JSON_ZLIB:
+            return json.loads(zlib.decompress(data[1:]))
+        elif data_format == FORMAT_MSGPACK:
+            return self._unpack(data[1:])
+        elif data_format == FORMAT_MSGPACK_ZLIB:
+            return self._unpack(zlib.decompress(data[1:]))
+        else:
+            # JSON text returned as bytes by the client
+            return json.loads(data)
+
+    def _unpack(self, data):
+        if msgpack is None:
+            raise Exception("Cannot decode msgpack cache value without msgpack")
+        return msgpack.unpackb(data, raw=False)
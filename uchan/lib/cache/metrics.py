@@ -0,0 +1,142 @@
+from bisect import bisect_left
+from collections import defaultdict
+from threading import Lock
+
+"""
+Counters of the cache round trips, grouped per key family. The family is the first part
+of the key, "thread" for thread:b:1 and "session$" for session$abc.
+The counters are kept per process, every worker process reports its own.
+"""
+
+# Upper bounds of the histogram buckets, the last bucket is +Inf
+BYTES_BUCKETS = [256, 1024, 4096, 16384, 65536, 262144, 1048576]
+LATENCY_BUCKETS = [0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25]
+
+
+def key_family(key: str):
+    for i, c in enumerate(key):
+        if c == ":":
+            return key[:i]
+        if c == "$":
+            return key[: i + 1]
+    return key
+
+
+class Histogram:
+    def __init__(self, buckets):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0
+        self.count = 0
+
+    def observe(self, value):
+        self.counts[bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+
+class CacheMetrics:
+    def __init__(self):
+        self.lock = Lock()
+        # (family, result) -> count
+        self.requests = defaultdict(int)
+        # (family, op) -> Histogram
+        self.value_bytes = {}
+        # (family, op) -> Histogram
+        self.latency = {}
+
+    def observe_read(self, op, keys, duration, values):
+        """
+        Record a read of keys, values are the raw values with None for a miss.
+        """
+        with self.lock:
+            for key, value in zip(keys, values, strict=True):
+                family = key_family(key)
+                if value is None:
+                    self.requests[(family, "miss")] += 1
+                else:
+                    self.requests[(family, "hit")] += 1
+                    self._observe_bytes(family, "read", len(value))
+            self._observe_latency(op, keys, duration)
+
+    def observe_write(self, op, keys, duration, values):
+        with self.lock:
+            for key, value in zip(keys, values, strict=True):
+                self._observe_bytes(key_family(key), "write", len(value))
+            self._observe_latency(op, keys, duration)
+
+    def observe(self, op, keys, duration):
+        with self.lock:
+            self._observe_latency(op, keys, duration)
+
+    def render(self):
+        """
+        Render the metrics in the Prometheus text format.
+        """
+        with self.lock:
+            lines = [
+                "# HELP uchan_cache_requests_total Cache lookups by key family.",
+                "# TYPE uchan_cache_requests_total counter",
+            ]
+            for (family, result), count in sorted(self.requests.items()):
+                labels = _labels(family=family, result=result)
+                lines.append(f"uchan_cache_requests_total{{{labels}}} {count}")
+
+            lines += [
+                "# HELP uchan_cache_value_bytes Size of the values read and written.",
+                "# TYPE uchan_cache_value_bytes histogram",
+            ]
+            for (family, op), histogram in sorted(self.value_bytes.items()):
+                lines += _render_histogram(
+                    "uchan_cache_value_bytes", histogram, family=family, op=op
+                )
+
+            lines += [
+                "# HELP uchan_cache_latency_seconds Duration of the cache round trips.",
+                "# TYPE uchan_cache_latency_seconds histogram",
+            ]
+            for (family, op), histogram in sorted(self.latency.items()):
+                lines += _render_histogram(
+                    "uchan_cache_latency_seconds", histogram, family=family, op=op
+                )
+
+        return "\n".join(lines) + "\n"
+
+    def _observe_bytes(self, family, op, size):
+        histogram = self.value_bytes.get((family, op))
+        if histogram is None:
+            histogram = self.value_bytes[(family, op)] = Histogram(BYTES_BUCKETS)
+        histogram.observe(size)
+
+    def _observe_latency(self, op, keys, duration):
+        # Multi key round trips over several families are counted as "mixed"
+        families = set(map(key_family, keys))
+        family = families.pop() if len(families) == 1 else "mixed"
+
+        histogram = self.latency.get((family, op))
+        if histogram is None:
+            histogram = self.latency[(family, op)] = Histogram(LATENCY_BUCKETS)
+        histogram.observe(duration)
+
+
+def _render_histogram(name, histogram: Histogram, **labels):
+    lines = []
+    cumulative = 0
+    bounds = list(map(str, histogram.buckets)) + ["+Inf"]
+    for bound, count in zip(bounds, histogram.counts, strict=True):
+        cumulative += count
+        bucket_labels = _labels(**labels, le=bound)
+        lines.append(f"{name}_bucket{{{bucket_labels}}} {cumulative}")
+    lines.append(f"{name}_sum{{{_labels(**labels)}}} {histogram.sum}")
+    lines.append(f"{name}_count{{{_labels(**labels)}}} {histogram.count}")
+    return lines
+
+
+def _labels(**labels):
+    return ",".join(
+        map(lambda i: '{}="{}"'.format(i[0], _escape(i[1])), labels.items())
+    )
+
+
+def _escape(value: str):
+    return value.replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
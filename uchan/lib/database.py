@@ -1,17 +1,24 @@
+import logging
+import threading
 from contextlib import contextmanager
 
+from flask import request
 from requests import Session
-from sqlalchemy import create_engine
+from sqlalchemy import create_engine, event
 from sqlalchemy.ext.declarative import declarative_base
 from sqlalchemy.orm import scoped_session, sessionmaker
 
 from uchan import config
 
+logger = logging.getLogger(__name__)
+
 OrmModelBase = declarative_base()
 
 _scoped_session = None
 _session_cls = None
 _engine = None
+# Statements executed by the current thread, see get_statement_count
+_statement_count = threading.local()
 
 
 @contextmanager
@@ -43,6 +50,38 @@ def register_teardown(flask_app):
         clean_up()
 
 
+def get_statement_count() -> int:
+    """
+    The number of SQL statements executed by this thread, since the last
+    reset_statement_count. The web app resets it for every request.
+    """
+    return getattr(_statement_count, "count", 0)
+
+
+def reset_statement_count():
+    _statement_count.count = 0
+
+
+def register_statement_counter(flask_app):
+    @flask_app.before_request
+    def reset_request_statement_count():
+        reset_statement_count()
+
+    @flask_app.after_request
+    def check_request_statement_count(response):
+        count = get_statement_count()
+        limit = config.database_request_statement_warning
+        if limit and count > limit:
+            logger.warning(
+                "%s %s executed %d sql statements", request.method, request.path, count
+            )
+        return response
+
+
+def _count_statement(*args):
+    _statement_count.count = get_statement_count() + 1
+
+
 # noinspection PyUnresolvedReferences
 def init_db():
     """Initialize function for the database."""
@@ -58,6 +97,8 @@ def init_db():
         echo=config.database_echo_sql,
     )
 
+    event.listen(_engine, "before_cursor_execute", _count_statement)
+
     _session_cls = sessionmaker(autocommit=False, autoflush=False, bind=_engine)
 
     _scoped_session = scoped_session(_session_cls)
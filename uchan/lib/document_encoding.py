@@ -0,0 +1,70 @@
+import gzip
+from typing import Dict, Optional
+
+from uchan import config
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+"""
+Compressed encodings of the documents that are served as they are stored, the API JSON
+and the rendered pages. They are made once when the document is written, instead of by
+the proxy on every request.
+Brotli is used when the brotli package is installed.
+"""
+
+ENCODING_GZIP = "gzip"
+ENCODING_BROTLI = "br"
+# All encodings that can be stored, preferred first
+ENCODINGS = [ENCODING_BROTLI, ENCODING_GZIP]
+
+GZIP_LEVEL = 6
+BROTLI_QUALITY = 5
+
+
+def available_encodings():
+    if not config.precompress_documents:
+        return []
+    if brotli is None:
+        return [ENCODING_GZIP]
+    return ENCODINGS
+
+
+def encode(data: bytes, encoding: str) -> bytes:
+    if encoding == ENCODING_BROTLI:
+        return brotli.compress(data, quality=BROTLI_QUALITY)
+    elif encoding == ENCODING_GZIP:
+        return gzip.compress(data, GZIP_LEVEL, mtime=0)
+    else:
+        raise Exception("Unknown encoding " + encoding)
+
+
+def encode_all(data: bytes) -> Dict[str, bytes]:
+    """
+    All available encodings of data, by content coding.
+    """
+    return {i: encode(data, i) for i in available_encodings()}
+
+
+def choose_encoding(accept_encodings) -> Optional[str]:
+    """
+    Choose the encoding to send from the Accept-Encoding header, a werkzeug Accept.
+    None to send the document without encoding.
+    """
+    best = None
+    best_quality = 0
+    for encoding in available_encodings():
+        quality = accept_encodings.quality(encoding)
+        if quality > best_quality:
+            best = encoding
+            best_quality = quality
+    return best
+
+
+def encoded_key(key: str, encoding: Optional[str]):
+    """
+    The cache key of the encoding of the document in key.
+    """
+    return key if encoding is None else key + ":" + encoding
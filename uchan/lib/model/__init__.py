@@ -265,7 +265,7 @@ class ThreadStubModel:
         m.sticky = thread.sticky
         m.locked = thread.locked
 
-        snippet_count = 1 if m.sticky else 5
+        snippet_count = m._snippet_count()
 
         m.original_length = len(thread.posts)
         m.omitted_count = max(0, m.original_length - 1 - snippet_count)
@@ -273,20 +273,38 @@ class ThreadStubModel:
         if include_snippets:
             m.posts = []
             for post in [thread.posts[0]] + thread.posts[1:][-snippet_count:]:
-                copy = post.copy()
-                # TODO: move outside of model logic
-                maxlinestext = (
-                    '<span class="abbreviated">'
-                    "Comment too long, view thread to read.</span>"
-                )
-                copy.html_text = parse_text(
-                    copy.text, maxlines=12, maxlinestext=maxlinestext
-                )
-                m.posts.append(copy)
+                m.posts.append(cls._snippet(post))
         if include_op:
             m.posts = [thread.posts[0]]
         return m
 
+    def add_reply(self, post: "PostModel", last_modified: int):
+        """
+        Update a stub created with snippets for a new reply to the thread, without
+        needing all posts of the thread.
+        """
+        snippet_count = self._snippet_count()
+
+        self.last_modified = last_modified
+        self.original_length += 1
+        self.omitted_count = max(0, self.original_length - 1 - snippet_count)
+
+        replies = self.posts[1:] + [self._snippet(post)]
+        self.posts = [self.posts[0]] + replies[-snippet_count:]
+
+    def _snippet_count(self):
+        return 1 if self.sticky else 5
+
+    @staticmethod
+    def _snippet(post: "PostModel"):
+        copy = post.copy()
+        # TODO: move outside of model logic
+        maxlinestext = (
+            '<span class="abbreviated">' "Comment too long, view thread to read.</span>"
+        )
+        copy.html_text = parse_text(copy.text, maxlines=12, maxlinestext=maxlinestext)
+        return copy
+
     @classmethod
     def from_cache(cls, cache: dict):
         m = cls()
@@ -333,9 +351,21 @@ class BoardModel:
         self.id: int = None
         self.name: str = None
         self.refno_counter: int = None
+        # Generation of the cache keys of the board, not part of the board cache
+        self.generation: int = None
 
         self.config: BoardConfigModel = None
 
+    def copy(self):
+        m = BoardModel()
+        m.id = self.id
+        m.name = self.name
+        m.refno_counter = self.refno_counter
+        m.generation = self.generation
+        if self.config:
+            m.config = self.config.copy()
+        return m
+
     @classmethod
     def from_name(cls, name):
         m = cls()
@@ -390,6 +420,19 @@ class BoardConfigModel:
         self.posting_verification_required: bool = None
         self.max_files: int = None
 
+    def copy(self):
+        m = BoardConfigModel()
+        m.id = self.id
+        m.pages = self.pages
+        m.per_page = self.per_page
+        m.full_name = self.full_name
+        m.description = self.description
+        m.bump_limit = self.bump_limit
+        m.file_posting = self.file_posting
+        m.posting_verification_required = self.posting_verification_required
+        m.max_files = self.max_files
+        return m
+
     @classmethod
     def from_defaults(cls):
         m = cls()
@@ -928,6 +971,7 @@ class BanModel:
         self.id: int = None
         self.ip4: int = None
         self.ip4_end: int = None
+        self.ip6: str = None
         self.reason: str = None
         self.date: int = None
         self.length: int = None
@@ -944,6 +988,7 @@ class BanModel:
         m.id = ban.id
         m.ip4 = ban.ip4
         m.ip4_end = ban.ip4_end
+        m.ip6 = ban.ip6
         m.reason = ban.reason
         m.date = ban.date
         m.length = ban.length
@@ -964,6 +1009,7 @@ class BanModel:
         m.id = self.id
         m.ip4 = self.ip4
         m.ip4_end = self.ip4_end
+        m.ip6 = self.ip6
         m.reason = self.reason
         m.date = self.date
         m.length = self.length
@@ -3,11 +3,12 @@ from sqlalchemy import (
     Boolean,
     Column,
     ForeignKey,
+    Index,
     Integer,
     LargeBinary,
     String,
 )
-from sqlalchemy.dialects.postgresql import ARRAY, JSON
+from sqlalchemy.dialects.postgresql import ARRAY, CIDR, JSON
 from sqlalchemy.ext.associationproxy import association_proxy
 from sqlalchemy.ext.mutable import Mutable
 from sqlalchemy.orm import backref, deferred, relationship
@@ -122,7 +123,7 @@ class PostOrmModel(OrmModelBase):
 
     id = Column(Integer(), primary_key=True)
 
-    thread_id = Column(Integer(), ForeignKey("thread.id"), nullable=False, index=True)
+    thread_id = Column(Integer(), ForeignKey("thread.id"), nullable=False)
     # thread is a backref property
 
     moderator_id = Column(
@@ -141,10 +142,18 @@ class PostOrmModel(OrmModelBase):
     date = Column(BigInteger(), nullable=False, index=True)
     name = Column(String())
     subject = Column(String())
-    text = Column(String(), index=True)
+    text = Column(String())
     refno = Column(Integer(), nullable=False, index=True)
     password = Column(String())
-    ip4 = Column(BigInteger(), nullable=False, index=True)
+    ip4 = Column(BigInteger(), nullable=False)
+
+    __table_args__ = (
+        # The posts of a thread, in order
+        Index("ix_post_thread_id_id", "thread_id", "id"),
+        # For the posting cooldown, see posts.find_last_post_date_by_ip4
+        Index("ix_post_ip4_date", "ip4", "date"),
+        Index("ix_post_thread_id_ip4_date", "thread_id", "ip4", "date"),
+    )
 
 
 class ReportOrmModel(OrmModelBase):
@@ -172,9 +181,9 @@ class ThreadOrmModel(OrmModelBase):
 
     id = Column(Integer(), primary_key=True)
 
-    board_id = Column(Integer(), ForeignKey("board.id"), nullable=False, index=True)
+    board_id = Column(Integer(), ForeignKey("board.id"), nullable=False)
     # board is a backref property
-    refno = Column(Integer(), nullable=False, index=True)
+    refno = Column(Integer(), nullable=False)
 
     last_modified = Column(BigInteger(), nullable=False, index=True)
     refno_counter = Column(Integer(), nullable=False, default=1)
@@ -188,6 +197,12 @@ class ThreadOrmModel(OrmModelBase):
         cascade="all, delete-orphan",
     )
 
+    __table_args__ = (
+        # Threads by refno, and the threads of a board by bump order
+        Index("ix_thread_board_id_refno", "board_id", "refno"),
+        Index("ix_thread_board_id_last_modified", "board_id", "last_modified"),
+    )
+
 
 class FileOrmModel(OrmModelBase):
     __tablename__ = "file"
@@ -209,9 +224,12 @@ class BanOrmModel(OrmModelBase):
     __tablename__ = "ban"
 
     id = Column(Integer(), primary_key=True)
-    ip4 = Column(BigInteger(), nullable=False, index=True)
+    # Null for IPv6 bans
+    ip4 = Column(BigInteger(), nullable=True, index=True)
     # Not null implies a range ban
     ip4_end = Column(BigInteger(), nullable=True, index=True)
+    # IPv6 address or prefix, instead of ip4
+    ip6 = Column(CIDR(), nullable=True)
     reason = Column(String(), nullable=False)
     date = Column(BigInteger(), nullable=False)
     # Use a length of 0 for permanent bans
@@ -236,7 +254,7 @@ class PageOrmModel(OrmModelBase):
     link_name = Column(String(), nullable=False, unique=True)
     type = Column(String(), nullable=False, index=True)
     order = Column(Integer(), nullable=False, index=True)
-    content = Column(String(), nullable=False, index=True)
+    content = Column(String(), nullable=False)
 
 
 class VerificationOrmModel(OrmModelBase):
@@ -261,12 +279,14 @@ class ModeratorLogOrmModel(OrmModelBase):
         Integer(), ForeignKey("moderator.id"), nullable=True, index=True
     )
     # moderator is a backref property
-    board_id = Column(Integer(), ForeignKey("board.id"), nullable=True, index=True)
+    board_id = Column(Integer(), ForeignKey("board.id"), nullable=True)
     # board is a backref property
 
     type = Column(Integer(), nullable=False, index=True)
     text = Column(String(), nullable=False)
 
+    __table_args__ = (Index("ix_moderatorlog_board_id_date", "board_id", "date"),)
+
 
 class RegCodeOrmModel(OrmModelBase):
     __tablename__ = "regcode"
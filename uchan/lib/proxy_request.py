@@ -1,3 +1,4 @@
+import ipaddress
 import logging
 
 from flask import request as request_ctx
@@ -22,6 +23,22 @@ def get_request_ip4(request=None):
     return ip4
 
 
+def get_request_ip(request=None):
+    """
+    The address of the request, an IPv4Address or IPv6Address. Posts and verifications
+    are bound to an IPv4 address, they use get_request_ip4.
+    IPv4 addresses mapped in IPv6, from a dual stack socket, are returned as IPv4.
+    """
+    try:
+        ip = ipaddress.ip_address(get_request_ip4_str(request))
+    except ValueError as e:
+        logger.exception("Failed to parse request ip")
+        raise ArgumentError("Invalid request") from e
+    if ip.version == 6 and ip.ipv4_mapped is not None:
+        ip = ip.ipv4_mapped
+    return ip
+
+
 def parse_ip4(ip4_str):
     ip_parts = ip4_str.split(".")
     if len(ip_parts) != 4:
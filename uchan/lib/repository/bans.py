@@ -2,10 +2,16 @@ from typing import List, Optional
 
 from sqlalchemy import desc
 
+from uchan import config
+from uchan.lib.ban_index import BanIndex
+from uchan.lib.cache import LocalCache
 from uchan.lib.database import session
 from uchan.lib.model import BanModel, BoardModel
 from uchan.lib.ormmodel import BanOrmModel
 
+# Holds the ban index, every change to the bans invalidates it in all workers.
+local_cache = LocalCache(namespace="bans", timeout=config.local_cache_timeout)
+
 
 # TODO: avoid duplicates
 def create_ban(ban: BanModel) -> BanModel:
@@ -13,6 +19,7 @@ def create_ban(ban: BanModel) -> BanModel:
         m = ban.to_orm_model()
         s.add(m)
         s.commit()
+        local_cache.invalidate()
         return BanModel.from_orm_model(m)
 
 
@@ -46,25 +53,28 @@ def find_by_id(ban_id: int) -> Optional[BanModel]:
         return res
 
 
-def find_by_ip4(ip4: int, for_board: BoardModel = None) -> List[BanModel]:
-    with session() as s:
-        q = s.query(BanOrmModel)
-        q = q.filter(
-            (BanOrmModel.ip4 == ip4)
-            | ((BanOrmModel.ip4 <= ip4) & (BanOrmModel.ip4_end >= ip4))
-        )
-
-        if for_board:
-            q = q.filter(
-                (BanOrmModel.board == None)  # noqa
-                | (BanOrmModel.board == for_board.name)
+def find_by_ip(ip, for_board: BoardModel = None) -> List[BanModel]:
+    """
+    Find the bans of ip, an int for IPv4 or an address from the ipaddress module, from
+    the ban index. Newest first.
+    """
+    res = get_ban_index().find(ip)
+    if for_board:
+        res = [i for i in res if i.board is None or i.board == for_board.name]
+    return sorted(res, key=lambda i: i.date, reverse=True)
+
+
+def get_ban_index() -> BanIndex:
+    ban_index = local_cache.get("ban_index")
+    if ban_index is None:
+        with session() as s:
+            q = s.query(BanOrmModel)
+            ban_index = BanIndex(
+                list(map(lambda i: BanModel.from_orm_model(i), q.all()))
             )
-
-        q = q.order_by(desc(BanOrmModel.date))
-
-        res = list(map(lambda i: BanModel.from_orm_model(i), q.all()))
-        s.commit()
-        return res
+            s.commit()
+        local_cache.set("ban_index", ban_index)
+    return ban_index
 
 
 def delete_ban(ban: BanModel):
@@ -72,3 +82,4 @@ def delete_ban(ban: BanModel):
         m = s.query(BanOrmModel).filter_by(id=ban.id).one()
         s.delete(m)
         s.commit()
+        local_cache.invalidate()
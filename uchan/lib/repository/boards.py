@@ -2,12 +2,26 @@ from typing import List, Optional, Tuple
 
 from sqlalchemy.orm import joinedload, load_only
 
+from uchan import config
 from uchan.lib import validation
-from uchan.lib.cache import LocalCache, cache, cache_key
+from uchan.lib.cache import (
+    LocalCache,
+    ModelCache,
+    cache,
+    cache_key,
+    missing_key,
+    set_missing,
+)
 from uchan.lib.database import session
 from uchan.lib.exceptions import ArgumentError
 from uchan.lib.model import BoardConfigModel, BoardModel, PostModel, ThreadModel
-from uchan.lib.ormmodel import BoardOrmModel, PostOrmModel, ThreadOrmModel
+from uchan.lib.ormmodel import (
+    BoardOrmModel,
+    ConfigOrmModel,
+    PostOrmModel,
+    ThreadOrmModel,
+)
+from uchan.lib.utils import now
 
 MESSAGE_DUPLICATE_BOARD_NAME = "Duplicate board name"
 MESSAGE_INVALID_NAME = "Invalid board name"
@@ -37,6 +51,8 @@ def create(board: BoardModel) -> BoardModel:
         board = board.from_orm_model(orm_board)
 
         cache.set(cache_key("board_and_config", board.name), board.to_cache())
+        cache.delete(missing_key(cache_key("board_and_config", board.name)))
+        board_model_cache.invalidate(cache_key("board_and_config", board.name))
 
         _set_all_board_names_cache(s)
 
@@ -47,9 +63,21 @@ def create(board: BoardModel) -> BoardModel:
 
 def update_config(board: BoardModel):
     with session() as s:
+        old_config = BoardConfigModel.from_orm_model(
+            s.query(ConfigOrmModel).filter_by(id=board.config.id).one()
+        )
+
         s.merge(board.config.to_orm_model())
         s.commit()
         cache.set(cache_key("board_and_config", board.name), board.to_cache())
+        board_model_cache.invalidate(cache_key("board_and_config", board.name))
+
+        # The cached pages are split with the old settings
+        if (old_config.pages, old_config.per_page) != (
+            board.config.pages,
+            board.config.per_page,
+        ):
+            bump_generation(board.name)
 
 
 def get_all() -> List[BoardModel]:
@@ -60,7 +88,14 @@ def get_all() -> List[BoardModel]:
         return res
 
 
-local_cache = LocalCache()
+local_cache = LocalCache(namespace="board_names", timeout=config.local_cache_timeout)
+
+board_model_cache = ModelCache(
+    cache,
+    config.local_cache_max_items,
+    config.local_cache_max_bytes,
+    config.local_cache_revalidate,
+)
 
 
 def get_all_board_names() -> List[str]:
@@ -142,19 +177,81 @@ def find_by_name(name: str) -> Optional[BoardModel]:
     if not validation.check_board_name_validity(name):
         raise ArgumentError(MESSAGE_INVALID_NAME)
 
-    board_cache = cache.get(cache_key("board_and_config", name))
-    if not board_cache:
+    board = board_model_cache.get(
+        cache_key("board_and_config", name), lambda: _load_board(name)
+    )
+    # The cached model is shared, the board config is modified by the mod views
+    return board.copy() if board else None
+
+
+def _load_board(name: str):
+    key = cache_key("board_and_config", name)
+    (board_cache, size), (generation, _), (missing, _) = cache.get_many_sized(
+        key, _generation_key(name), missing_key(key)
+    )
+
+    if board_cache:
+        board = BoardModel.from_cache(board_cache)
+    elif missing:
+        return None
+    else:
         with session() as s:
             q = s.query(BoardOrmModel).filter_by(name=name)
             q = q.options(joinedload(BoardOrmModel.config))
             board_orm_model = q.one_or_none()
             if not board_orm_model:
+                set_missing(key)
                 return None
             board = BoardModel.from_orm_model(board_orm_model, include_config=True)
-            cache.set(cache_key("board_and_config", name), board.to_cache())
-            return board
+            cache.set(key, board.to_cache())
+            # From the database, don't keep it locally
+            size = None
+
+    if generation is None:
+        generation = _init_generation(name)
+    board.generation = generation
+    return board, size
 
-    return BoardModel.from_cache(board_cache)
+
+def find_board_version(board_name: str) -> Optional[str]:
+    """
+    Get the version of the board and its config, it changes after every update. None
+    when it has no version yet.
+    """
+    return board_model_cache.get_version(cache_key("board_and_config", board_name))
+
+
+def find_generation(name: str) -> int:
+    """
+    Get the generation of the board from memcache. The generation is part of the cache
+    keys of the threads and pages of the board.
+    """
+    generation = cache.get(_generation_key(name))
+    if generation is None:
+        generation = _init_generation(name)
+    return generation
+
+
+def bump_generation(name: str):
+    """
+    Invalidate the caches of all threads and pages of the board at once, by moving
+    their keys to a new generation. The old keys fall out of memcache by themselves.
+    """
+    generation = max(now(), find_generation(name) + 1)
+    cache.set(_generation_key(name), generation, timeout=0)
+    board_model_cache.invalidate(cache_key("board_and_config", name))
+
+
+def _init_generation(name: str) -> int:
+    generation = now()
+    if not cache.add(_generation_key(name), generation, timeout=0):
+        # Another worker was first
+        generation = cache.get(_generation_key(name)) or generation
+    return generation
+
+
+def _generation_key(name: str):
+    return "generation$" + cache_key("board", name)
 
 
 def find_by_names(names: List[str]) -> List[BoardModel]:
@@ -165,9 +262,11 @@ def find_by_names(names: List[str]) -> List[BoardModel]:
             raise ArgumentError(MESSAGE_INVALID_NAME)
 
     boards = []
+    board_caches = cache.get_many(
+        *map(lambda i: cache_key("board_and_config", i), names)
+    )
     with session() as s:
-        for name in names:
-            board_cache = cache.get(cache_key("board_and_config", name))
+        for name, board_cache in zip(names, board_caches, strict=True):
             if board_cache:
                 boards.append(BoardModel.from_cache(board_cache))
             else:
@@ -190,11 +289,13 @@ def delete(board: BoardModel):
         s.delete(b)
         s.commit()
 
-        # The pages etc. will fall out of the cache themselves. This is the first thing
-        # all board related endpoints use, so they get cancelled at the start of the
-        # request. If any are still working with caches of this board let them use the
-        # leftover caches.
+        # This is the first thing all board related endpoints use, so they get
+        # cancelled at the start of the request. If any are still working with caches
+        # of this board let them use the leftover caches. A new board with the same name
+        # starts at a new generation, the old pages etc. will fall out of the cache
+        # themselves.
         cache.delete(cache_key("board_and_config", board.name))
+        bump_generation(board.name)
 
         _set_all_board_names_cache(s)
 
@@ -211,3 +312,4 @@ def _set_all_board_names_cache(s):
         cache_key("all_board_names"),
         list(map(lambda i: i.name, all_board_names_q.all())),
     )
+    local_cache.invalidate()
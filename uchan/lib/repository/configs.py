@@ -1,3 +1,4 @@
+from uchan import config
 from uchan.lib.cache import LocalCache, cache, cache_key
 from uchan.lib.database import session
 from uchan.lib.model import SiteConfigModel
@@ -18,7 +19,9 @@ MESSAGE_SITE_CONFIG_EXISTS = "Site config already exists"
 #         return r
 
 
-local_site_config_cache = LocalCache()
+local_site_config_cache = LocalCache(
+    namespace="site_config", timeout=config.local_cache_timeout
+)
 
 
 def update_site(site_config: SiteConfigModel):
@@ -26,6 +29,7 @@ def update_site(site_config: SiteConfigModel):
         s.merge(site_config.to_orm_model())
         s.commit()
         cache.set(cache_key("config_site"), site_config.to_cache())
+        local_site_config_cache.invalidate()
 
 
 def get_site() -> SiteConfigModel:
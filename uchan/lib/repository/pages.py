@@ -2,6 +2,7 @@ from typing import List
 
 from sqlalchemy import asc
 
+from uchan import config
 from uchan.lib import validation
 from uchan.lib.cache import LocalCache, cache, cache_key
 from uchan.lib.database import session
@@ -22,7 +23,7 @@ MESSAGE_PAGE_INVALID_ORDER = "Invalid page order"
 MESSAGE_PAGE_INVALID_LINK = "Invalid page link"
 MESSAGE_PAGE_DUPLICATE_LINK = "Duplicate link name"
 
-local_cache = LocalCache()
+local_cache = LocalCache(namespace="pages", timeout=config.local_cache_timeout)
 
 
 def create(page: PageModel) -> PageModel:
@@ -135,6 +136,7 @@ def delete(page: PageModel):
 
         cache.delete(cache_key("page_by_link_name", page.link_name))
         _cache_pages_by_type(s, page.type)
+        local_cache.invalidate()
 
         s.commit()
 
@@ -142,6 +144,7 @@ def delete(page: PageModel):
 def _cache_page(s, page: PageModel):
     cache.set(cache_key("page_by_link_name", page.link_name), page.to_cache())
     _cache_pages_by_type(s, page.type)
+    local_cache.invalidate()
 
 
 def _cache_pages_by_type(s, page_type):
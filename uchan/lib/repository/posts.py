@@ -1,10 +1,24 @@
-from typing import List, Optional, Tuple
-
-from sqlalchemy import desc
-from sqlalchemy.orm import Session, lazyload
-
-from uchan.lib import document_cache
-from uchan.lib.cache import cache, cache_key
+import logging
+from bisect import bisect_right
+from typing import Dict, List, Optional, Tuple
+from uuid import uuid4
+
+from sqlalchemy import case, desc, func, update
+from sqlalchemy.orm import Session, joinedload, selectinload
+
+from uchan import config
+from uchan.lib import document_cache, document_encoding
+from uchan.lib.broker import Subscription, broker
+from uchan.lib.cache import (
+    REBUILD_LOCK_TIMEOUT,
+    ModelCache,
+    cache,
+    cache_key,
+    cache_lock,
+    missing_key,
+    rebuild_once,
+    set_missing,
+)
 from uchan.lib.database import session
 from uchan.lib.exceptions import ArgumentError
 from uchan.lib.model import (
@@ -17,10 +31,22 @@ from uchan.lib.model import (
     ThreadStubModel,
 )
 from uchan.lib.ormmodel import BoardOrmModel, FileOrmModel, PostOrmModel, ThreadOrmModel
+from uchan.lib.repository import boards
+from uchan.lib.service import api_service
 from uchan.lib.utils import now
 
+logger = logging.getLogger(__name__)
+
 MESSAGE_POST_HAS_NO_FILE = "Post has no file"
 
+# Always check the version, a posting client should see its post on the next request.
+thread_model_cache = ModelCache(
+    cache,
+    config.local_cache_max_items,
+    config.local_cache_max_bytes,
+    revalidate_timeout=0,
+)
+
 
 def create_post(
     board: BoardModel, thread: ThreadModel, post: PostModel, sage: bool
@@ -28,51 +54,44 @@ def create_post(
     start_time = now()
     with session() as s:
         post_orm_model = post.to_orm_model()
-
-        s.add(post_orm_model)
-
-        to_thread_orm_model = s.query(ThreadOrmModel).filter_by(id=thread.id).one()
-
-        post_orm_model.thread = to_thread_orm_model
-        post_orm_model.refno = 0
-
-        # Atomically update the refno counter
-        to_thread_orm_model.refno_counter = ThreadOrmModel.refno_counter + 1
-        s.commit()
-
-        # Set it to the post after the commit to make sure there aren't any duplicates
-        post_refno = post_orm_model.refno = to_thread_orm_model.refno_counter
-        post_id = post_orm_model.id
-
-        # Attach files to the post id
+        post_orm_model.thread_id = thread.id
         if post.files:
-            for file in post.files:
-                file_orm_model = file.to_orm_model()
-                file_orm_model.post_id = post_id
-                s.add(file_orm_model)
-
+            post_orm_model.files = list(map(lambda i: i.to_orm_model(), post.files))
         if post.moderator:
             post_orm_model.moderator_id = post.moderator.id
 
-        modify_date = now()
+        # Allocate the refno and bump the thread in one statement. It locks the thread
+        # row until the commit, the post is inserted in the same transaction.
+        values = {"refno_counter": ThreadOrmModel.refno_counter + 1}
+        if not sage:
+            # Use the refno to avoid a count(*)
+            values["last_modified"] = case(
+                (ThreadOrmModel.refno_counter < board.config.bump_limit, now()),
+                else_=ThreadOrmModel.last_modified,
+            )
+        post_refno = post_orm_model.refno = _allocate_refno(
+            s, ThreadOrmModel, thread.id, values
+        )
 
-        # Use the refno to avoid a count(*)
-        if not sage and post_refno <= board.config.bump_limit:
-            to_thread_orm_model.last_modified = modify_date
+        s.add(post_orm_model)
         s.commit()
 
         insert_time = now() - start_time
         start_time = now()
 
-        _invalidate_thread_cache(s, thread, board)
-        _invalidate_board_pages_catalog_cache(s, board)
+        namespace = _board_namespace(board, current=True)
+        _, thread_stub = _invalidate_thread_cache(
+            s, namespace, thread, board, post_orm_model
+        )
+        _update_board_caches(s, namespace, board, {thread.refno: thread_stub})
 
         # Wait for the thread to be purged, otherwise the chance exists that the client
         # reloads a cached version. This only holds up the posting client, others have
         # the updated memcache available.
         document_cache.purge_thread(board, thread, True)
-        # Don't wait for this
-        document_cache.purge_board(board)
+
+        # After the caches are updated, the watchers then fetch the new post
+        _publish_thread_post(board, thread, post_refno)
 
         cache_time = now() - start_time
 
@@ -87,36 +106,29 @@ def create_thread(
 ) -> Tuple[PostResultModel, int, int]:
     start_time = now()
     with session() as s:
-        board_orm_model = s.query(BoardOrmModel).filter_by(id=board.id).one()
-
         thread_orm_model = ThreadOrmModel()
         thread_orm_model.last_modified = now()
-        thread_orm_model.refno = 0
         thread_orm_model.board_id = board.id
 
         post_orm_model = post.to_orm_model()
-
         post_orm_model.thread = thread_orm_model
         post_orm_model.refno = 1
-        s.add(thread_orm_model)
-
-        # Atomically update the refno counter
-        board_orm_model.refno_counter = BoardOrmModel.refno_counter + 1
-        s.commit()
-
-        # Set it to the board after the commit to make sure there aren't any duplicates
-        thread_refno = thread_orm_model.refno = board_orm_model.refno_counter
-
-        # Attach files to the post id
         if post.files:
-            for file in post.files:
-                file_orm_model = file.to_orm_model()
-                file_orm_model.post_id = post_orm_model.id
-                s.add(file_orm_model)
-
+            post_orm_model.files = list(map(lambda i: i.to_orm_model(), post.files))
         if post.moderator:
             post_orm_model.moderator_id = post.moderator.id
 
+        # The board row is locked until the commit, like the thread row for replies
+        thread_refno = thread_orm_model.refno = _allocate_refno(
+            s,
+            BoardOrmModel,
+            board.id,
+            {"refno_counter": BoardOrmModel.refno_counter + 1},
+        )
+        s.add(thread_orm_model)
+        # The purge must see the new thread
+        s.flush()
+
         # Purge overflowed threads
         threads_refnos_to_purge = _purge_threads(
             s, board, board.config.pages, board.config.per_page
@@ -126,15 +138,34 @@ def create_thread(
         insert_time = now() - start_time
         start_time = now()
 
+        namespace = _board_namespace(board, current=True)
+
+        # The refno could have been looked up before it existed
+        purged_keys = [missing_key(cache_key("thread", namespace, thread_refno))]
+        purged_thread_keys = []
         for purging_refno in threads_refnos_to_purge:
-            cache.delete(cache_key("thread", board.name, purging_refno))
-            cache.delete(cache_key("thread_stub", board.name, purging_refno))
+            purged_thread_keys.append(cache_key("thread", namespace, purging_refno))
+            purged_keys.append(cache_key("thread_stub", namespace, purging_refno))
+            purged_keys += _document_keys(
+                _thread_document_key(namespace, purging_refno)
+            )
+        purged_headers = cache.get_many(*purged_thread_keys)
+        for purging_refno, header in zip(
+            threads_refnos_to_purge, purged_headers, strict=True
+        ):
+            purged_keys += _thread_chunk_keys(namespace, purging_refno, header)
+        purged_keys += purged_thread_keys
+        cache.delete_many(*purged_keys)
+        if purged_thread_keys:
+            thread_model_cache.invalidate(*purged_thread_keys)
 
         thread = ThreadModel.from_orm_model(thread_orm_model)
-        _invalidate_thread_cache(s, thread, board)
-        _invalidate_board_pages_catalog_cache(s, board)
+        _, thread_stub = _invalidate_thread_cache(s, namespace, thread, board)
 
-        document_cache.purge_board(board)
+        changed_thread_stubs = {thread.refno: thread_stub}
+        for purging_refno in threads_refnos_to_purge:
+            changed_thread_stubs[purging_refno] = None
+        _update_board_caches(s, namespace, board, changed_thread_stubs)
 
         cache_time = now() - start_time
 
@@ -155,11 +186,15 @@ def delete_post(post: PostModel):
 
             thread = post.thread
 
-            _invalidate_thread_cache(s, thread, thread.board)
-            _invalidate_board_pages_catalog_cache(s, thread.board)
+            namespace = _board_namespace(thread.board)
+            _, thread_stub = _invalidate_thread_cache(
+                s, namespace, thread, thread.board
+            )
+            _update_board_caches(
+                s, namespace, thread.board, {thread.refno: thread_stub}
+            )
 
             document_cache.purge_thread(thread.board, thread)
-            document_cache.purge_board(thread.board)
 
 
 def delete_post_file(post: PostModel):
@@ -173,11 +208,11 @@ def delete_post_file(post: PostModel):
 
         thread = post.thread
 
-        _invalidate_thread_cache(s, thread, thread.board)
-        _invalidate_board_pages_catalog_cache(s, thread.board)
+        namespace = _board_namespace(thread.board)
+        _, thread_stub = _invalidate_thread_cache(s, namespace, thread, thread.board)
+        _update_board_caches(s, namespace, thread.board, {thread.refno: thread_stub})
 
         document_cache.purge_thread(thread.board, thread)
-        document_cache.purge_board(thread.board)
 
 
 def delete_thread(thread: ThreadModel):
@@ -186,11 +221,11 @@ def delete_thread(thread: ThreadModel):
         s.delete(thread_orm_model)
         s.commit()
 
-        _invalidate_thread_cache(s, thread, thread.board)
-        _invalidate_board_pages_catalog_cache(s, thread.board)
+        namespace = _board_namespace(thread.board)
+        _, thread_stub = _invalidate_thread_cache(s, namespace, thread, thread.board)
+        _update_board_caches(s, namespace, thread.board, {thread.refno: thread_stub})
 
         document_cache.purge_thread(thread.board, thread)
-        document_cache.purge_board(thread.board)
 
 
 def update_thread_sticky(thread: ThreadModel, sticky: bool):
@@ -199,11 +234,11 @@ def update_thread_sticky(thread: ThreadModel, sticky: bool):
         existing.sticky = sticky
         s.commit()
 
-        _invalidate_thread_cache(s, thread, thread.board)
-        _invalidate_board_pages_catalog_cache(s, thread.board)
+        namespace = _board_namespace(thread.board)
+        _, thread_stub = _invalidate_thread_cache(s, namespace, thread, thread.board)
+        _update_board_caches(s, namespace, thread.board, {thread.refno: thread_stub})
 
         document_cache.purge_thread(thread.board, thread)
-        document_cache.purge_board(thread.board)
 
 
 def update_thread_locked(thread: ThreadModel, locked: bool):
@@ -212,11 +247,11 @@ def update_thread_locked(thread: ThreadModel, locked: bool):
         existing.locked = locked
         s.commit()
 
-        _invalidate_thread_cache(s, thread, thread.board)
-        _invalidate_board_pages_catalog_cache(s, thread.board)
+        namespace = _board_namespace(thread.board)
+        _, thread_stub = _invalidate_thread_cache(s, namespace, thread, thread.board)
+        _update_board_caches(s, namespace, thread.board, {thread.refno: thread_stub})
 
         document_cache.purge_thread(thread.board, thread)
-        document_cache.purge_board(thread.board)
 
 
 def find_post_by_id(post_id: int, include_thread=False) -> Optional[PostModel]:
@@ -232,10 +267,89 @@ def find_post_by_id(post_id: int, include_thread=False) -> Optional[PostModel]:
 def find_thread_by_board_name_thread_refno(
     board_name: str, thread_refno: int
 ) -> Optional[ThreadModel]:
-    thread_cache = cache.get(cache_key("thread", board_name, thread_refno))
+    namespace = _namespace(board_name, boards.find_generation(board_name))
+    return thread_model_cache.get(
+        cache_key("thread", namespace, thread_refno),
+        lambda: _load_thread(namespace, board_name, thread_refno),
+    )
+
+
+def find_thread_by_board_thread_refno_with_posts(
+    board: BoardModel, thread_refno: int
+) -> Optional[ThreadModel]:
+    namespace = _board_namespace(board)
+    return thread_model_cache.get(
+        cache_key("thread", namespace, thread_refno),
+        lambda: _load_thread_with_posts(namespace, board, thread_refno),
+    )
+
+
+def find_thread_posts_after(
+    board: BoardModel, thread_refno: int, after_refno: int
+) -> Optional[ThreadModel]:
+    """
+    Get the thread with only the posts with a refno higher than after_refno. Only the
+    chunks of the thread cache that have these posts are read.
+    """
+    namespace = _board_namespace(board)
+    thread_cache = cache.get(cache_key("thread", namespace, thread_refno))
+    if thread_cache and "chunk_refnos" in thread_cache:
+        posts_cache = _get_thread_posts_cache_after(
+            namespace, thread_refno, thread_cache, after_refno
+        )
+        if posts_cache is not None:
+            thread = ThreadModel.from_cache(thread_cache)
+            thread.posts = list(map(lambda i: PostModel.from_cache(i), posts_cache))
+            return thread
+
+    # Not cached in chunks, or a chunk is missing, the normal read caches it again.
+    cached_thread = find_thread_by_board_thread_refno_with_posts(board, thread_refno)
+    if not cached_thread:
+        return None
+    # The cached model is shared, copy it.
+    thread = ThreadModel.from_cache(cached_thread.to_cache())
+    thread.posts = [i for i in cached_thread.posts if i.refno > after_refno]
+    return thread
+
+
+def _get_thread_posts_cache_after(
+    namespace: str, thread_refno: int, thread_cache, after_refno: int
+):
+    """
+    Get the post caches after after_refno from the chunks of the thread. None when a
+    chunk is missing or doesn't line up with the header.
+    """
+    if after_refno >= thread_cache["refno_counter"]:
+        return []
+
+    # The first chunk that can have posts after after_refno
+    chunk_refnos = thread_cache["chunk_refnos"]
+    first_chunk = max(bisect_right(chunk_refnos, after_refno) - 1, 0)
+    chunk_keys = _thread_chunk_keys(namespace, thread_refno, thread_cache)
+
+    posts_cache = []
+    for chunk_cache in cache.get_many(*chunk_keys[first_chunk:]):
+        if chunk_cache is None:
+            return None
+        posts_cache += chunk_cache
+
+    # Same checks as _get_thread_cache
+    post_count = thread_cache["post_count"] - first_chunk * THREAD_CHUNK_SIZE
+    if len(posts_cache) < post_count:
+        return None
+    return [i for i in posts_cache[:post_count] if i["refno"] > after_refno]
+
+
+def _load_thread(namespace: str, board_name: str, thread_refno: int):
+    key = cache_key("thread", namespace, thread_refno)
+    thread_cache, missing = cache.get_many(key, missing_key(key))
     if not thread_cache:
+        if missing:
+            return None
+
         with session() as s:
             q = s.query(ThreadOrmModel)
+            q = q.options(joinedload(ThreadOrmModel.board))
             q = q.filter(
                 ThreadOrmModel.refno == thread_refno,
                 ThreadOrmModel.board_id == BoardOrmModel.id,
@@ -244,50 +358,62 @@ def find_thread_by_board_name_thread_refno(
             thread_orm_model = q.one_or_none()
 
             if not thread_orm_model:
+                set_missing(key)
                 return None
 
-            # TODO: also load board in q above
             thread = ThreadModel.from_orm_model(thread_orm_model, include_board=True)
-            return thread
+            # Without posts, don't keep it with the cached threads
+            return thread, None
 
-    if thread_cache:
-        return ThreadModel.from_cache(thread_cache)
-    return None
+    # Only the header, without the post chunks
+    return ThreadModel.from_cache(thread_cache), None
 
 
-def find_thread_by_board_thread_refno_with_posts(
-    board: BoardModel, thread_refno: int
-) -> Optional[ThreadModel]:
-    thread_cache = cache.get(cache_key("thread", board.name, thread_refno))
-    if not thread_cache:
-        with session() as s:
-            q = s.query(ThreadOrmModel)
-            q = q.options(lazyload(ThreadOrmModel.posts))
-            q = q.filter(
-                ThreadOrmModel.refno == thread_refno,
-                ThreadOrmModel.board_id == BoardOrmModel.id,
-                BoardOrmModel.name == board.name,
-            )
-            thread_orm_model = q.one_or_none()
+def _load_thread_with_posts(namespace: str, board: BoardModel, thread_refno: int):
+    key = cache_key("thread", namespace, thread_refno)
+    loaded = _load_cached_thread(namespace, thread_refno)
+    if loaded is None:
+        if cache.get(missing_key(key)):
+            return None
 
-            if not thread_orm_model or not thread_orm_model.posts:
-                return None
+        loaded = rebuild_once(
+            key,
+            lambda: _load_cached_thread(namespace, thread_refno),
+            lambda: _rebuild_thread_with_posts(namespace, board, thread_refno),
+        )
+    return loaded
 
-            # TODO: also load board in q above
-            thread = ThreadModel.from_orm_model(
-                thread_orm_model, include_board=True, include_posts=True
-            )
-            thread_cache = thread.to_cache(include_board=True, include_posts=True)
-            cache.set(
-                cache_key("thread", thread.board.name, thread.refno),
-                thread_cache,
-                timeout=0,
-            )
-            return thread
 
-    if thread_cache:
-        return ThreadModel.from_cache(thread_cache)
-    return None
+def _load_cached_thread(namespace: str, thread_refno: int):
+    thread_cache, posts_cache, size = _get_thread_cache(namespace, thread_refno)
+    if posts_cache is None:
+        return None
+    thread_cache["posts"] = posts_cache
+    return ThreadModel.from_cache(thread_cache), size
+
+
+def _rebuild_thread_with_posts(namespace: str, board: BoardModel, thread_refno: int):
+    with session() as s:
+        q = s.query(ThreadOrmModel)
+        q = q.options(*_thread_with_posts_options())
+        q = q.filter(
+            ThreadOrmModel.refno == thread_refno,
+            ThreadOrmModel.board_id == BoardOrmModel.id,
+            BoardOrmModel.name == board.name,
+        )
+        thread_orm_model = q.one_or_none()
+
+        if not thread_orm_model:
+            set_missing(cache_key("thread", namespace, thread_refno))
+            return None
+        if not thread_orm_model.posts:
+            return None
+
+        thread = ThreadModel.from_orm_model(
+            thread_orm_model, include_board=True, include_posts=True
+        )
+        _set_thread_cache(namespace, thread)
+        return thread, None
 
 
 def find_posts_by_ip4_from_time(
@@ -309,26 +435,218 @@ def find_posts_by_ip4_from_time(
         return res
 
 
+def find_last_post_date_by_ip4(
+    ip4: int, from_time: int, by_thread: ThreadModel = None
+) -> Optional[int]:
+    """
+    The date of the newest post from ip4 since from_time, in by_thread, or of the
+    threads it started when by_thread is None. None when there is no such post.
+    Used for the posting cooldown, the posts themselves aren't loaded.
+    """
+    with session() as s:
+        q = s.query(func.max(PostOrmModel.date))
+        q = q.filter((PostOrmModel.ip4 == ip4) & (PostOrmModel.date >= from_time))
+
+        if by_thread:
+            q = q.filter_by(thread_id=by_thread.id)
+        else:
+            q = q.filter_by(refno=1)
+
+        res = q.scalar()
+        s.commit()
+        return res
+
+
 def get_board_page(board: BoardModel, page: int) -> BoardPageModel:
-    board_page_cache = cache.get(cache_key("board", board.name, page))
+    namespace = _board_namespace(board)
+    key = cache_key("board", namespace, page)
+    board_page_cache = cache.get(key)
     if not board_page_cache:
-        with session() as s:
-            catalog, board_pages = _invalidate_board_pages_catalog_cache(s, board)
-            return board_pages[page]
+
+        def load():
+            res = cache.get(key)
+            return BoardPageModel.from_cache(res) if res else None
+
+        def rebuild():
+            with session() as s:
+                catalog, board_pages = _rebuild_board_pages_catalog_cache(
+                    s, namespace, board
+                )
+                return board_pages[page]
+
+        # All pages and the catalog are rebuilt together, use one lock for them
+        return rebuild_once(cache_key("board", namespace), load, rebuild)
 
     return BoardPageModel.from_cache(board_page_cache)
 
 
 def get_catalog(board: BoardModel) -> CatalogModel:
-    catalog_cache = cache.get(cache_key("board", board.name))
+    namespace = _board_namespace(board)
+    key = cache_key("board", namespace)
+    catalog_cache = cache.get(key)
     if not catalog_cache:
-        with session() as s:
-            catalog, board_pages = _invalidate_board_pages_catalog_cache(s, board)
-            return catalog
+
+        def load():
+            res = cache.get(key)
+            return CatalogModel.from_cache(res) if res else None
+
+        def rebuild():
+            with session() as s:
+                catalog, board_pages = _rebuild_board_pages_catalog_cache(
+                    s, namespace, board
+                )
+                return catalog
+
+        return rebuild_once(key, load, rebuild)
 
     return CatalogModel.from_cache(catalog_cache)
 
 
+def get_thread_document(
+    board: BoardModel, thread_refno: int, encoding: Optional[str] = None
+) -> Optional[bytes]:
+    """
+    Get the API JSON of the thread, as written along with the thread cache. With an
+    encoding from document_encoding the encoded document is returned.
+    """
+    namespace = _board_namespace(board)
+    document_key = _thread_document_key(namespace, thread_refno)
+    return _get_encoded_document(
+        document_key,
+        encoding,
+        lambda: _get_thread_document(namespace, board, thread_refno, document_key),
+    )
+
+
+def _get_thread_document(
+    namespace: str, board: BoardModel, thread_refno: int, document_key: str
+):
+    document = cache.get_raw(document_key)
+    if document is not None:
+        return document
+
+    thread = find_thread_by_board_thread_refno_with_posts(board, thread_refno)
+    if thread is None:
+        return None
+
+    # Missing after an eviction, or when the thread was cached before the document
+    # existed. It is made from the cached thread under the lock that new replies take
+    # too, so that a reply can't be missing from it.
+    with cache_lock(cache_key("thread", namespace, thread_refno)) as acquired:
+        document = cache.get_raw(document_key)
+        if document is None:
+            loaded = _load_cached_thread(namespace, thread_refno) if acquired else None
+            if loaded is not None:
+                document = api_service.thread_document(loaded[0])
+                cache.set_many(
+                    {},
+                    timeout=0,
+                    raw_mapping=_document_mapping(document_key, document),
+                )
+            else:
+                document = api_service.thread_document(thread)
+    return document
+
+
+def get_catalog_document(board: BoardModel, encoding: Optional[str] = None) -> bytes:
+    """
+    Get the API JSON of the catalog, as written along with the catalog cache. With an
+    encoding from document_encoding the encoded document is returned.
+    """
+    namespace = _board_namespace(board)
+    document_key = _catalog_document_key(namespace)
+
+    def load():
+        document = cache.get_raw(document_key)
+        if document is None:
+            document = api_service.catalog_document(get_catalog(board))
+            # Every catalog update sets the document, a newer one is not replaced.
+            cache.add_raw(document_key, document, timeout=0)
+        return document
+
+    return _get_encoded_document(document_key, encoding, load)
+
+
+def _get_encoded_document(document_key: str, encoding: Optional[str], load):
+    """
+    Get the document from load, or its encoding. The encodings are written along with
+    the document, a missing one is made from the document.
+    """
+    if encoding is None:
+        return load()
+
+    encoded_key = document_encoding.encoded_key(document_key, encoding)
+    encoded = cache.get_raw(encoded_key)
+    if encoded is None:
+        document = load()
+        if document is None:
+            return None
+        encoded = document_encoding.encode(document, encoding)
+        # Writers set all encodings, a newer one is not replaced.
+        cache.add_raw(encoded_key, encoded, timeout=0)
+    return encoded
+
+
+def subscribe_thread(board: BoardModel, thread_refno: int) -> Subscription:
+    """
+    Subscribe to the new replies of the thread, the messages are the post refnos.
+    Close the subscription when done.
+    """
+    return broker.subscribe(_thread_channel(board.name, thread_refno))
+
+
+def _publish_thread_post(board: BoardModel, thread: ThreadModel, post_refno: int):
+    if not config.thread_events:
+        return
+    try:
+        broker.publish(_thread_channel(board.name, thread.refno), str(post_refno))
+    except Exception:
+        # The watchers still poll, the post itself was made
+        logger.exception("failed to publish thread post")
+
+
+def _thread_channel(board_name: str, thread_refno: int):
+    return cache_key("thread", board_name, thread_refno)
+
+
+def find_thread_version(board: BoardModel, thread_refno: int) -> Optional[str]:
+    """
+    Get the version of the thread cache, it changes after every update of the thread.
+    None when the thread has no version yet, or does not exist.
+    """
+    namespace = _board_namespace(board)
+    return thread_model_cache.get_version(cache_key("thread", namespace, thread_refno))
+
+
+def find_board_pages_version(board: BoardModel) -> str:
+    """
+    Get the version of the board pages and the catalog, it changes after every update
+    of them.
+    """
+    namespace = _board_namespace(board)
+    key = _board_pages_version_key(namespace)
+    version = cache.get(key)
+    if version is None:
+        # Pages read after this are at least as new, a write in between changes the
+        # version again.
+        version = uuid4().hex
+        if not cache.add(key, version, timeout=0):
+            version = cache.get(key)
+    return version
+
+
+def _allocate_refno(s: Session, orm_model, row_id: int, values) -> int:
+    """
+    Increment the refno_counter of the board or thread row with UPDATE ... RETURNING,
+    and return the new counter. Other values of the row are updated in the same
+    statement.
+    """
+    q = update(orm_model).where(orm_model.id == row_id).values(**values)
+    q = q.returning(orm_model.refno_counter)
+    q = q.execution_options(synchronize_session=False)
+    return s.execute(q).scalar_one()
+
+
 def _purge_threads(s: Session, board: BoardModel, pages: int, per_page: int):
     limit = (per_page * pages) - 1
 
@@ -360,30 +678,73 @@ def _gather_statistics(insert_time, cache_time, post_details):
 BOARD_SNIPPET_COUNT = 5
 BOARD_SNIPPET_MAX_LINES = 12
 
+# Subtracted from the score of stickies in the board index, larger than any timestamp
+BOARD_INDEX_STICKY_OFFSET = 10**14
+
+# Posts of a thread are cached in chunks of this many posts, the thread cache itself
+# is a header listing the chunks. A new reply only rewrites the last chunk.
+THREAD_CHUNK_SIZE = 50
 
-def _invalidate_thread_cache(s: Session, old_thread: ThreadModel, board: BoardModel):
+
+def _invalidate_thread_cache(
+    s: Session,
+    namespace: str,
+    old_thread: ThreadModel,
+    board: BoardModel,
+    new_post: PostOrmModel = None,
+):
     """
     Update the memcache version of the specified thread. This will update the thread
     cache, and the thread stub cache.
+    When new_post is a new reply and the caches are complete, only the reply is added
+    to them. No thread is returned in that case.
     """
-    key = cache_key("thread", board.name, old_thread.refno)
-    stub_key = cache_key("thread_stub", board.name, old_thread.refno)
+    with cache_lock(cache_key("thread", namespace, old_thread.refno)):
+        if new_post is not None:
+            thread_stub = _append_thread_cache_post(
+                namespace, old_thread.refno, new_post
+            )
+            if thread_stub is not None:
+                return None, thread_stub
+
+        return _rebuild_thread_cache(s, namespace, old_thread)
+
+
+def _thread_with_posts_options():
+    """
+    Load options for a thread with its board and posts. The posts, their files and
+    their moderators are loaded with one statement each, instead of one per post.
+    """
+    return [
+        joinedload(ThreadOrmModel.board),
+        selectinload(ThreadOrmModel.posts).selectinload(PostOrmModel.files),
+        selectinload(ThreadOrmModel.posts).selectinload(PostOrmModel.moderator),
+    ]
+
+
+def _rebuild_thread_cache(s: Session, namespace: str, old_thread: ThreadModel):
+    key = cache_key("thread", namespace, old_thread.refno)
+    stub_key = cache_key("thread_stub", namespace, old_thread.refno)
+    document_key = _thread_document_key(namespace, old_thread.refno)
 
     # Reuse the parsed html from the old cache.
-    old_thread_posts_cache = cache.get(key)
+    old_thread_cache, old_posts_cache, _ = _get_thread_cache(
+        namespace, old_thread.refno
+    )
     old_thread_posts = None
-    if old_thread_posts_cache:
-        old_thread_posts = ThreadModel.from_cache(old_thread_posts_cache).posts
+    if old_posts_cache:
+        old_thread_posts = list(map(lambda i: PostModel.from_cache(i), old_posts_cache))
+    old_chunk_keys = _thread_chunk_keys(namespace, old_thread.refno, old_thread_cache)
 
     # Next, query all the new posts
     q = s.query(ThreadOrmModel)
     q = q.filter_by(id=old_thread.id)
-    q = q.options(lazyload(ThreadOrmModel.posts))
+    q = q.options(*_thread_with_posts_options())
     res = q.one_or_none()
     if not res:
-        cache.delete(key)
-        cache.delete(stub_key)
-        return
+        cache.delete_many(key, stub_key, *_document_keys(document_key), *old_chunk_keys)
+        thread_model_cache.invalidate(key)
+        return None, None
 
     thread = ThreadModel.from_orm_model(
         res,
@@ -392,8 +753,8 @@ def _invalidate_thread_cache(s: Session, old_thread: ThreadModel, board: BoardMo
         cached_thread_posts=old_thread_posts,
     )
 
-    thread_cache = thread.to_cache(include_board=True, include_posts=True)
-    cache.set(key, thread_cache, timeout=0)
+    _set_thread_cache(namespace, thread, len(old_chunk_keys))
+    thread_model_cache.invalidate(key)
 
     thread_stub = ThreadStubModel.from_thread(thread, include_snippets=True)
     thread_stub_cache = thread_stub.to_cache()
@@ -402,7 +763,242 @@ def _invalidate_thread_cache(s: Session, old_thread: ThreadModel, board: BoardMo
     return thread, thread_stub
 
 
-def _invalidate_board_pages_catalog_cache(s: Session, board: BoardModel):
+def _append_thread_cache_post(
+    namespace: str, thread_refno: int, post_orm_model: PostOrmModel
+):
+    """
+    Add a new reply to the thread cache and the thread stub cache, only the header and
+    the last chunk of posts are rewritten.
+    Returns the new thread stub, or None when the caches are missing or don't line up
+    with the reply, and the thread needs a full update.
+    """
+    key = cache_key("thread", namespace, thread_refno)
+    stub_key = cache_key("thread_stub", namespace, thread_refno)
+    document_key = _thread_document_key(namespace, thread_refno)
+
+    thread_cache, thread_stub_cache = cache.get_many(key, stub_key)
+    if not thread_cache or "chunk_refnos" not in thread_cache or not thread_stub_cache:
+        return None
+
+    # The reply must directly follow the cached posts, otherwise another reply was
+    # posted in between.
+    if post_orm_model.refno != thread_cache["refno_counter"] + 1:
+        return None
+
+    chunk_refnos = thread_cache["chunk_refnos"]
+    chunk = len(chunk_refnos) - 1
+    chunk_key = _thread_chunk_key(namespace, thread_refno, chunk)
+    chunk_cache = cache.get(chunk_key)
+    if chunk_cache is None or thread_cache[
+        "post_count"
+    ] != chunk * THREAD_CHUNK_SIZE + len(chunk_cache):
+        return None
+
+    post = PostModel.from_orm_model(post_orm_model)
+    if len(chunk_cache) >= THREAD_CHUNK_SIZE:
+        chunk += 1
+        chunk_key = _thread_chunk_key(namespace, thread_refno, chunk)
+        chunk_cache = []
+        chunk_refnos.append(post.refno)
+    chunk_cache.append(post.to_cache())
+
+    thread_orm_model = post_orm_model.thread
+    thread_cache["last_modified"] = thread_orm_model.last_modified
+    thread_cache["refno_counter"] = thread_orm_model.refno_counter
+    thread_cache["post_count"] += 1
+
+    thread_stub = ThreadStubModel.from_cache(thread_stub_cache)
+    thread_stub.add_reply(post, thread_orm_model.last_modified)
+
+    # A missing document is made again from the cache when it is requested, its
+    # encodings can't be updated without it.
+    documents = {}
+    document = cache.get_raw(document_key)
+    if document is not None:
+        documents = _document_mapping(
+            document_key,
+            api_service.append_thread_document(
+                document, ThreadModel.from_cache(thread_cache), post
+            ),
+        )
+    else:
+        cache.delete_many(*_document_keys(document_key))
+
+    # Write the chunk before the header, readers check the chunks against the header.
+    mapping = {
+        chunk_key: chunk_cache,
+        key: thread_cache,
+        stub_key: thread_stub.to_cache(),
+    }
+    written = cache.set_many(mapping, timeout=0, raw_mapping=documents)
+    if len(written) != len(mapping) + len(documents):
+        cache.delete_many(key, stub_key, *_document_keys(document_key))
+    thread_model_cache.invalidate(key)
+
+    return thread_stub
+
+
+def _get_thread_cache(namespace: str, thread_refno: int):
+    """
+    Get the thread header and the posts from all chunks, in one round trip for the
+    chunks. Returns a tuple of the header, the list of post caches and the total size
+    of the data. The posts are None when the header or a chunk is missing.
+    """
+    thread_cache, size = cache.get_sized(cache_key("thread", namespace, thread_refno))
+    if not thread_cache:
+        return None, None, 0
+    if "chunk_refnos" not in thread_cache:
+        # Cached before the posts were split in chunks
+        return thread_cache, thread_cache.get("posts"), size
+
+    posts_cache = []
+    chunk_keys = _thread_chunk_keys(namespace, thread_refno, thread_cache)
+    for chunk_cache, chunk_size in cache.get_many_sized(*chunk_keys):
+        if chunk_cache is None:
+            return thread_cache, None, size
+        posts_cache += chunk_cache
+        size += chunk_size
+
+    # Replies added after the header was read show up on the next read. Fewer posts
+    # mean the chunks were rewritten after a delete.
+    post_count = thread_cache["post_count"]
+    if len(posts_cache) < post_count:
+        return thread_cache, None, size
+    return thread_cache, posts_cache[:post_count], size
+
+
+def _set_thread_cache(namespace: str, thread: ThreadModel, old_chunk_count=0):
+    """
+    Write the thread header and all chunks of posts. Chunks past the new last chunk,
+    left over from before a delete, are removed.
+    """
+    key = cache_key("thread", namespace, thread.refno)
+
+    posts_cache = list(map(lambda i: i.to_cache(), thread.posts))
+    chunk_refnos = []
+    mapping = {}
+    for i in range(0, len(posts_cache), THREAD_CHUNK_SIZE):
+        chunk_cache = posts_cache[i : i + THREAD_CHUNK_SIZE]
+        chunk_key = _thread_chunk_key(namespace, thread.refno, len(chunk_refnos))
+        mapping[chunk_key] = chunk_cache
+        chunk_refnos.append(chunk_cache[0]["refno"])
+
+    thread_cache = thread.to_cache(include_board=True)
+    thread_cache["post_count"] = len(posts_cache)
+    thread_cache["chunk_refnos"] = chunk_refnos
+    mapping[key] = thread_cache
+
+    document_key = _thread_document_key(namespace, thread.refno)
+    documents = _document_mapping(document_key, api_service.thread_document(thread))
+
+    written = cache.set_many(mapping, timeout=0, raw_mapping=documents)
+    if len(written) != len(mapping) + len(documents):
+        cache.delete_many(key, *_document_keys(document_key))
+
+    if old_chunk_count > len(chunk_refnos):
+        cache.delete_many(
+            *map(
+                lambda i: _thread_chunk_key(namespace, thread.refno, i),
+                range(len(chunk_refnos), old_chunk_count),
+            )
+        )
+
+
+def _thread_chunk_key(namespace: str, thread_refno: int, chunk: int):
+    return cache_key("thread_posts", namespace, thread_refno, chunk)
+
+
+def _thread_document_key(namespace: str, thread_refno: int):
+    return cache_key("thread_json", namespace, thread_refno)
+
+
+def _catalog_document_key(namespace: str):
+    return cache_key("catalog_json", namespace)
+
+
+def _document_mapping(document_key: str, document: bytes):
+    """
+    The raw cache mapping of the document and its encodings.
+    """
+    mapping = {document_key: document}
+    for encoding, encoded in document_encoding.encode_all(document).items():
+        mapping[document_encoding.encoded_key(document_key, encoding)] = encoded
+    return mapping
+
+
+def _document_keys(document_key: str):
+    """
+    The keys of the document and all its encodings, also the ones not in use.
+    """
+    return [document_key] + list(
+        map(
+            lambda i: document_encoding.encoded_key(document_key, i),
+            document_encoding.ENCODINGS,
+        )
+    )
+
+
+def _set_board_pages_version(namespace: str):
+    # Set after the pages, a version is never newer than the pages.
+    cache.set(_board_pages_version_key(namespace), uuid4().hex, timeout=0)
+
+
+def _board_pages_version_key(namespace: str):
+    return "version$" + cache_key("board", namespace)
+
+
+def _thread_chunk_keys(namespace: str, thread_refno: int, thread_cache):
+    if not thread_cache or "chunk_refnos" not in thread_cache:
+        return []
+    return list(
+        map(
+            lambda i: _thread_chunk_key(namespace, thread_refno, i),
+            range(len(thread_cache["chunk_refnos"])),
+        )
+    )
+
+
+def _rebuild_board_pages_catalog_cache(s: Session, namespace: str, board: BoardModel):
+    """
+    _invalidate_board_pages_catalog_cache with the lock of the board index, so that it
+    does not overwrite the index while an incremental update is using it. The caller
+    needs the rebuilt pages, it continues when the lock wasn't acquired. The board is
+    then flagged, to be rebuilt again after the update holding the lock.
+    """
+    with cache_lock(cache_key("board_index", namespace)) as acquired:
+        res = _invalidate_board_pages_catalog_cache(s, namespace, board)
+        if not acquired:
+            cache.set(_board_rebuild_key(namespace), True, timeout=0)
+    _rebuild_flagged_board(s, namespace, board)
+    return res
+
+
+def _rebuild_flagged_board(s: Session, namespace: str, board: BoardModel):
+    """
+    Rebuild the pages of the board when an update that could not get the lock of the
+    board index flagged it. Called after releasing the lock, and after setting the flag.
+    When the lock is taken, its holder calls this after releasing it, so the flag is
+    always handled by someone holding the lock.
+    """
+    lock_key = "lock$" + cache_key("board_index", namespace)
+    rebuild_key = _board_rebuild_key(namespace)
+    while cache.get(rebuild_key):
+        if not cache.add(lock_key, True, timeout=REBUILD_LOCK_TIMEOUT):
+            return
+        try:
+            cache.delete(rebuild_key)
+            _invalidate_board_pages_catalog_cache(s, namespace, board)
+        finally:
+            cache.delete(lock_key)
+
+
+def _board_rebuild_key(namespace: str):
+    return "rebuild$" + cache_key("board_index", namespace)
+
+
+def _invalidate_board_pages_catalog_cache(
+    s: Session, namespace: str, board: BoardModel
+):
     """
     Update the memcache version of the specified board.
     This will update the board pages from the already cached thread stubs, and create a
@@ -426,12 +1022,14 @@ def _invalidate_board_pages_catalog_cache(s: Session, board: BoardModel):
     # is build from only the ops.
     stickies = []
     threads = []
-    for thread in thread_models:
-        thread_stub_cache = cache.get(
-            cache_key("thread_stub", board.name, thread.refno)
-        )
+    thread_stub_caches = cache.get_many(
+        *map(lambda i: cache_key("thread_stub", namespace, i.refno), thread_models)
+    )
+    for thread, thread_stub_cache in zip(
+        thread_models, thread_stub_caches, strict=True
+    ):
         if not thread_stub_cache:
-            thread, thread_stub = _invalidate_thread_cache(s, thread, board)
+            thread, thread_stub = _invalidate_thread_cache(s, namespace, thread, board)
             # The board and thread selects are done separately and there is thus the
             # possibility that the thread was removed after the board select
             if thread_stub is None:
@@ -443,14 +1041,17 @@ def _invalidate_board_pages_catalog_cache(s: Session, board: BoardModel):
             thread_stub
         )
 
-    stickies = sorted(stickies, key=lambda t: t.last_modified, reverse=False)
-    threads = sorted(threads, key=lambda t: t.last_modified, reverse=True)
-    all_thread_stubs = stickies + threads
+    # Sorted the same as the board index ordered set, which breaks ties on the refno
+    all_thread_stubs = sorted(
+        stickies + threads, key=lambda t: _board_index_item(t)[::-1]
+    )
+
+    # The bump order as an ordered set, used to incrementally update the pages
+    # afterwards
+    board_index = list(map(lambda i: _board_index_item(i), all_thread_stubs))
 
     # The catalog is a CatalogModel with ThreadStubs with only OP's
     catalog = CatalogModel.from_board_thread_stubs(board, all_thread_stubs)
-    catalog_cache = catalog.to_cache()
-    cache.set(cache_key("board", board.name), catalog_cache, timeout=0)
 
     # All threads with stubs, divided per page
     # note: there is the possibility that concurrent processes updating this cache
@@ -467,7 +1068,267 @@ def _invalidate_board_pages_catalog_cache(s: Session, board: BoardModel):
         )
         board_pages.append(board_page)
 
-        board_page_cache = board_page.to_cache()
-        cache.set(cache_key("board", board.name, i), board_page_cache, timeout=0)
+    cache.ordered_set_replace(cache_key("board_index", namespace), board_index)
+
+    board_caches = {
+        cache_key("board", namespace): catalog.to_cache(),
+    }
+    for board_page in board_pages:
+        board_caches[
+            cache_key("board", namespace, board_page.page)
+        ] = board_page.to_cache()
+    documents = _document_mapping(
+        _catalog_document_key(namespace), api_service.catalog_document(catalog)
+    )
+    cache.set_many(board_caches, timeout=0, raw_mapping=documents)
+    _set_board_pages_version(namespace)
 
     return catalog, board_pages
+
+
+def _board_index_item(thread_stub: ThreadStubModel):
+    """
+    The member and score of the thread in the board index ordered set. Stickies first,
+    oldest first, then normal threads, newest first.
+    """
+    if thread_stub.sticky:
+        score = thread_stub.last_modified - BOARD_INDEX_STICKY_OFFSET
+    else:
+        score = -thread_stub.last_modified
+    return str(thread_stub.refno), score
+
+
+def regenerate_board(board_name: str):
+    """
+    Regenerate the pages and catalog of a board that was marked dirty, and purge them.
+    Called from the board task after the regenerate window.
+    """
+    # Clear it first, changes during the regeneration schedule another one.
+    cache.delete(_board_dirty_key(board_name))
+
+    with session() as s:
+        board_orm_model = (
+            s.query(BoardOrmModel).filter_by(name=board_name).one_or_none()
+        )
+        if not board_orm_model:
+            return
+        board = BoardModel.from_orm_model(board_orm_model)
+
+        _rebuild_board_pages_catalog_cache(s, _board_namespace(board), board)
+
+    document_cache.purge_board(board)
+
+
+def _update_board_caches(
+    s: Session,
+    namespace: str,
+    board: BoardModel,
+    changed_thread_stubs: "Dict[int, ThreadStubModel]",
+):
+    """
+    Update the pages and catalog of the board after the changed threads were updated.
+    With the worker, busy boards are only regenerated once per regenerate window, the
+    first change in a window schedules the board task and marks the board dirty.
+    """
+    window = config.board_regenerate_window
+    if config.bypass_worker or window <= 0:
+        _update_board_pages_catalog_cache(s, namespace, board, changed_thread_stubs)
+        document_cache.purge_board(board)
+        return
+
+    # Keep the mark a while longer than the window, in case the task got lost.
+    dirty_timeout = window // 1000 + REBUILD_LOCK_TIMEOUT
+    if not cache.add(_board_dirty_key(board.name), True, timeout=dirty_timeout):
+        return
+
+    from uchan.lib.tasks.board_task import regenerate_board_task
+
+    try:
+        regenerate_board_task.apply_async((board.name,), countdown=window / 1000)
+    except Exception:
+        logger.exception("failed to schedule board regeneration, updating now")
+        cache.delete(_board_dirty_key(board.name))
+        _update_board_pages_catalog_cache(s, namespace, board, changed_thread_stubs)
+        document_cache.purge_board(board)
+
+
+def _board_dirty_key(board_name: str):
+    return "dirty$" + cache_key("board", board_name)
+
+
+def _board_namespace(board: BoardModel, current=False):
+    """
+    The board part of the cache keys of its threads and pages, the board name with the
+    board generation. Bumping the generation moves all of these keys at once.
+    The generation of the board model can lag behind by the local cache revalidation
+    time. Writes use current to read it from memcache, so that they never write to a
+    generation the readers already left.
+    """
+    generation = board.generation
+    if current or generation is None:
+        generation = boards.find_generation(board.name)
+    return _namespace(board.name, generation)
+
+
+def _namespace(board_name: str, generation: int):
+    return "{}@{}".format(board_name, generation)
+
+
+def _update_board_pages_catalog_cache(
+    s: Session,
+    namespace: str,
+    board: BoardModel,
+    changed_thread_stubs: Dict[int, Optional[ThreadStubModel]],
+):
+    """
+    Update the memcache version of the specified board for only the changed threads.
+    changed_thread_stubs maps thread refnos to their new stub, or None when the thread
+    was removed. The cached bump order is updated, and only the pages whose threads
+    changed are rewritten. Falls back to a full rebuild when the caches needed for
+    this are missing.
+    """
+
+    if not config.board_index_incremental:
+        _rebuild_board_pages_catalog_cache(s, namespace, board)
+        return
+
+    index_key = cache_key("board_index", namespace)
+    # The pages are made from the index that is read here, the whole update must be
+    # done by one process at a time.
+    with cache_lock(index_key) as acquired:
+        if acquired:
+            _update_board_index_pages(s, namespace, board, changed_thread_stubs)
+        else:
+            # The update holding the lock writes pages without this change. Leave the
+            # pages to it, it rebuilds them from the database when they are flagged.
+            cache.set(_board_rebuild_key(namespace), True, timeout=0)
+    _rebuild_flagged_board(s, namespace, board)
+
+
+def _update_board_index_pages(
+    s: Session,
+    namespace: str,
+    board: BoardModel,
+    changed_thread_stubs: Dict[int, Optional[ThreadStubModel]],
+):
+    """
+    The incremental update of _update_board_pages_catalog_cache, with the lock of the
+    board index held.
+    """
+    index_key = cache_key("board_index", namespace)
+    board_index = cache.ordered_set_get(index_key)
+    catalog_cache = cache.get(cache_key("board", namespace))
+    if board_index is None or catalog_cache is None:
+        _invalidate_board_pages_catalog_cache(s, namespace, board)
+        return
+
+    old_order = list(map(lambda i: int(i[0]), board_index))
+
+    # Remove the changed threads and insert them again at their new position
+    added = {}
+    removed = []
+    for refno, thread_stub in changed_thread_stubs.items():
+        if thread_stub is None:
+            removed.append(str(refno))
+        else:
+            member, score = _board_index_item(thread_stub)
+            added[member] = score
+    if not cache.ordered_set_update(index_key, added, removed):
+        _invalidate_board_pages_catalog_cache(s, namespace, board)
+        return
+
+    changed_members = set(map(str, changed_thread_stubs))
+    board_index = [i for i in board_index if i[0] not in changed_members]
+    board_index = sorted(board_index + list(added.items()), key=lambda i: i[::-1])
+    new_order = list(map(lambda i: int(i[0]), board_index))
+
+    per_page = board.config.per_page
+    old_position_by_refno = {refno: i for i, refno in enumerate(old_order)}
+
+    changed_pages = []
+    for i in range(board.config.pages):
+        old_refnos = old_order[i * per_page : (i + 1) * per_page]
+        new_refnos = new_order[i * per_page : (i + 1) * per_page]
+        if old_refnos != new_refnos or any(
+            refno in changed_thread_stubs for refno in new_refnos
+        ):
+            changed_pages.append(i)
+
+    # The stubs of threads that moved to another page are taken from the page they
+    # were on before.
+    old_pages_needed = set()
+    for i in changed_pages:
+        for refno in new_order[i * per_page : (i + 1) * per_page]:
+            if refno not in changed_thread_stubs and refno in old_position_by_refno:
+                old_pages_needed.add(old_position_by_refno[refno] // per_page)
+
+    old_pages_needed = sorted(old_pages_needed)
+    old_board_page_caches = cache.get_many(
+        *map(lambda i: cache_key("board", namespace, i), old_pages_needed)
+    )
+
+    stub_cache_by_refno = {}
+    for board_page_cache in old_board_page_caches:
+        if board_page_cache is None:
+            _invalidate_board_pages_catalog_cache(s, namespace, board)
+            return
+        for thread_stub_cache in board_page_cache["threads"]:
+            stub_cache_by_refno[thread_stub_cache["refno"]] = thread_stub_cache
+
+    for refno, thread_stub in changed_thread_stubs.items():
+        if thread_stub is not None:
+            stub_cache_by_refno[refno] = thread_stub.to_cache()
+
+    catalog_stub_cache_by_refno = {}
+    for thread_stub_cache in catalog_cache["threads"]:
+        catalog_stub_cache_by_refno[thread_stub_cache["refno"]] = thread_stub_cache
+    for refno, thread_stub in changed_thread_stubs.items():
+        if thread_stub is not None:
+            catalog_stub_cache_by_refno[refno] = thread_stub.to_op_only().to_cache()
+
+    # Threads that were beyond the last page are not in any page cache
+    missing_refnos = []
+    for i in changed_pages:
+        for refno in new_order[i * per_page : (i + 1) * per_page]:
+            if refno not in stub_cache_by_refno:
+                missing_refnos.append(refno)
+    if missing_refnos:
+        missing_stub_caches = cache.get_many(
+            *map(lambda i: cache_key("thread_stub", namespace, i), missing_refnos)
+        )
+        for refno, thread_stub_cache in zip(
+            missing_refnos, missing_stub_caches, strict=True
+        ):
+            if thread_stub_cache is None:
+                _invalidate_board_pages_catalog_cache(s, namespace, board)
+                return
+            stub_cache_by_refno[refno] = thread_stub_cache
+
+    board_caches = {}
+    for i in changed_pages:
+        board_caches[cache_key("board", namespace, i)] = {
+            "page": i,
+            "threads": list(
+                map(
+                    lambda j: stub_cache_by_refno[j],
+                    new_order[i * per_page : (i + 1) * per_page],
+                )
+            ),
+        }
+
+    catalog_thread_stub_caches = []
+    for refno in new_order:
+        if refno not in catalog_stub_cache_by_refno:
+            _invalidate_board_pages_catalog_cache(s, namespace, board)
+            return
+        catalog_thread_stub_caches.append(catalog_stub_cache_by_refno[refno])
+    catalog_cache["threads"] = catalog_thread_stub_caches
+
+    # Same as with the full rebuild, concurrent updates may cause a visual glitch.
+    board_caches[cache_key("board", namespace)] = catalog_cache
+    documents = _document_mapping(
+        _catalog_document_key(namespace),
+        api_service.catalog_document(CatalogModel.from_cache(catalog_cache)),
+    )
+    cache.set_many(board_caches, timeout=0, raw_mapping=documents)
+    _set_board_pages_version(namespace)
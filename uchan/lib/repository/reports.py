@@ -87,7 +87,8 @@ def find_by_moderator(
         q = q.options(
             joinedload(ReportOrmModel.post)
             .joinedload(PostOrmModel.thread)
-            .joinedload(ThreadOrmModel.board)
+            .joinedload(ThreadOrmModel.board),
+            joinedload(ReportOrmModel.post).selectinload(PostOrmModel.moderator),
         )
         q = q.offset(page * per_page).limit(per_page)
 
@@ -0,0 +1,116 @@
+import json
+
+from uchan.lib.model import CatalogModel, PostModel, ThreadModel
+from uchan.lib.service import file_service
+
+# The posts are the last field of the thread object, new replies are inserted
+# before the end of the document.
+THREAD_DOCUMENT_POSTS = b'"posts":['
+THREAD_DOCUMENT_END = b"]}}"
+
+
+def thread_document(thread: ThreadModel) -> bytes:
+    """
+    The API response of the thread with all its posts, as JSON bytes.
+    """
+    posts_data = b",".join(map(lambda i: _dumps(build_post_object(i)), thread.posts))
+    return _thread_document(thread, posts_data)
+
+
+def append_thread_document(document: bytes, thread: ThreadModel, post: PostModel):
+    """
+    Add a new reply to a document made with thread_document. thread only needs the
+    thread fields, its posts are not used.
+    """
+    posts_start = document.index(THREAD_DOCUMENT_POSTS) + len(THREAD_DOCUMENT_POSTS)
+    posts_data = document[posts_start : -len(THREAD_DOCUMENT_END)]
+    if posts_data:
+        posts_data += b","
+    posts_data += _dumps(build_post_object(post))
+    return _thread_document(thread, posts_data)
+
+
+def catalog_document(catalog: CatalogModel) -> bytes:
+    """
+    The API response of the catalog, as JSON bytes.
+    """
+    return _dumps(
+        {"threads": list(map(lambda i: build_thread_object(i), catalog.threads))}
+    )
+
+
+def build_thread_object(thread: ThreadModel):
+    thread_obj = _build_thread_fields(thread)
+
+    posts = []
+
+    for post in thread.posts:
+        posts.append(build_post_object(post))
+
+    thread_obj["posts"] = posts
+
+    return thread_obj
+
+
+def build_post_object(post: PostModel):
+    post_obj = {"id": post.id, "refno": post.refno, "date": post.date}
+
+    if post.html_text:
+        post_obj["html"] = post.html_text
+
+    if post.name:
+        post_obj["name"] = post.name
+
+    if post.subject:
+        post_obj["subject"] = post.subject
+
+    if post.mod_code:
+        post_obj["modCode"] = post.mod_code
+
+    if post.files:
+        files_obj = []
+        for file in post.files:
+            file_obj = {
+                "location": file_service.resolve_to_uri(file.location),
+                "thumbnailLocation": file_service.resolve_to_uri(
+                    file.thumbnail_location
+                ),
+                "name": file.original_name,
+                "width": file.width,
+                "height": file.height,
+                "size": file.size,
+                "thumbnailWidth": file.thumbnail_width,
+                "thumbnailHeight": file.thumbnail_height,
+            }
+            files_obj.append(file_obj)
+
+        post_obj["files"] = files_obj
+
+    return post_obj
+
+
+def _build_thread_fields(thread: ThreadModel):
+    thread_obj = {
+        # 'id': thread.id,
+        "refno": thread.refno,
+        "lastModified": thread.last_modified,
+    }
+
+    if thread.locked:
+        thread_obj["locked"] = True
+
+    if thread.sticky:
+        thread_obj["sticky"] = True
+
+    return thread_obj
+
+
+def _thread_document(thread: ThreadModel, posts_data: bytes):
+    thread_obj = _build_thread_fields(thread)
+    thread_obj["posts"] = []
+    data = _dumps({"thread": thread_obj})
+    return data[: -len(THREAD_DOCUMENT_END)] + posts_data + THREAD_DOCUMENT_END
+
+
+def _dumps(obj):
+    return json.dumps(obj, separators=(",", ":")).encode()
@@ -1,11 +1,12 @@
 """Takes care of bans and post cooldowns"""
 
+import ipaddress
 from typing import Tuple
 
 from uchan.lib.exceptions import ArgumentError
 from uchan.lib.mod_log import mod_log
 from uchan.lib.model import BanModel, BoardModel, ThreadModel
-from uchan.lib.proxy_request import get_request_ip4
+from uchan.lib.proxy_request import get_request_ip
 from uchan.lib.repository import bans, posts
 from uchan.lib.service import board_service
 from uchan.lib.utils import ip4_to_str, now
@@ -17,12 +18,15 @@ MAX_REASON_LENGTH = 2000
 
 MESSAGE_BAN_TOO_LONG = "Ban too long"
 MESSAGE_IP4_ILLEGAL_RANGE = "ip4 end must be bigger than ip4"
+MESSAGE_IP_MISSING = "A ban needs either an ip4 or an ip6"
+MESSAGE_IP_BOTH = "A ban needs either an ip4 or an ip6, not both"
+MESSAGE_IP6_INVALID = "Invalid IPv6 address or prefix"
 MESSAGE_BOARD_NOT_FOUND = "Board not found"
 MESSAGE_BAN_TEXT_TOO_LONG = "Ban reason text too long"
 
 
-def is_request_banned(ip4, board):
-    bans = find_bans(ip4, board)
+def is_request_banned(ip, board):
+    bans = find_bans(ip, board)
     return len(bans) > 0
 
 
@@ -32,41 +36,32 @@ def is_request_suspended(
     timeout = NEW_THREAD_COOLDOWN if thread is None else NEW_POST_COOLDOWN
     from_time = now() - timeout
 
-    post_list = posts.find_posts_by_ip4_from_time(ip4, from_time, by_thread=thread)
+    last_post_date = posts.find_last_post_date_by_ip4(ip4, from_time, by_thread=thread)
 
-    if post_list:
-        most_recent = post_list[0]
-        time_left = (most_recent.date + timeout - now()) // 1000
+    if last_post_date is not None:
+        time_left = (last_post_date + timeout - now()) // 1000
         return True, time_left
     return False, 0
 
 
 def get_request_bans(clear_if_expired=False):
-    ip4 = get_request_ip4()
-    return find_bans(ip4, clear_if_expired=clear_if_expired)
+    ip = get_request_ip()
+    return find_bans(ip, clear_if_expired=clear_if_expired)
 
 
-def find_bans(ip4: int, board: BoardModel = None, clear_if_expired=False):
-    ban_list = bans.find_by_ip4(ip4, board)
-
-    applied_bans = list(filter(lambda i: ban_applies(i, ip4, board), ban_list))
+def find_bans(ip, board: BoardModel = None, clear_if_expired=False):
+    """
+    Find the bans of ip, an int for IPv4 or an address from the ipaddress module. With
+    a board only the bans for that board and for all boards.
+    """
+    ban_list = bans.find_by_ip(ip, board)
 
     if clear_if_expired:
         # Delete the ban after the user has seen it when it expired
         for ban in filter(lambda i: ban_expired(i), ban_list):
             delete_ban(ban)
 
-    return applied_bans
-
-
-def ban_applies(ban: BanModel, ip4: int, board: BoardModel) -> bool:
-    if ban.board and board and ban.board != board.name:
-        return False
-
-    if ban.ip4_end is not None:
-        return ban.ip4 < ip4 < ban.ip4_end
-    else:
-        return ban.ip4 == ip4
+    return ban_list
 
 
 def ban_expired(ban: BanModel) -> bool:
@@ -79,6 +74,19 @@ def add_ban(ban: BanModel) -> BanModel:
     if ban.length > MAX_BAN_TIME:
         raise ArgumentError(MESSAGE_BAN_TOO_LONG)
 
+    if ban.ip6 is not None:
+        if ban.ip4 is not None or ban.ip4_end is not None:
+            raise ArgumentError(MESSAGE_IP_BOTH)
+        try:
+            network = ipaddress.ip_network(ban.ip6, strict=False)
+        except ValueError as e:
+            raise ArgumentError(MESSAGE_IP6_INVALID) from e
+        if network.version != 6:
+            raise ArgumentError(MESSAGE_IP6_INVALID)
+        ban.ip6 = str(network)
+    elif ban.ip4 is None:
+        raise ArgumentError(MESSAGE_IP_MISSING)
+
     if ban.ip4_end is not None and ban.ip4_end <= ban.ip4:
         raise ArgumentError(MESSAGE_IP4_ILLEGAL_RANGE)
 
@@ -95,12 +103,12 @@ def add_ban(ban: BanModel) -> BanModel:
     ban = bans.create_ban(ban)
 
     for_board_text = " on {}".format(ban.board) if ban.board else ""
-    ip4_end_text = ip4_to_str(ban.ip4_end) if ban.ip4_end is not None else "-"
+    ip_end_text = ip4_to_str(ban.ip4_end) if ban.ip4_end is not None else "-"
     f = "ban add {} from {} to {}{} for {} hours reason {}"
     text = f.format(
         ban.id,
-        ip4_to_str(ban.ip4),
-        ip4_end_text,
+        ban_ip_text(ban),
+        ip_end_text,
         for_board_text,
         ban.length / 60 / 60 / 1000,
         ban.reason,
@@ -110,6 +118,13 @@ def add_ban(ban: BanModel) -> BanModel:
     return ban
 
 
+def ban_ip_text(ban: BanModel) -> str:
+    """
+    The start address of an IPv4 ban, or the IPv6 address or prefix.
+    """
+    return ban.ip6 if ban.ip6 is not None else ip4_to_str(ban.ip4)
+
+
 def delete_ban(ban: BanModel):
     bans.delete_ban(ban)
 
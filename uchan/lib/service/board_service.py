@@ -26,6 +26,10 @@ def find_board(board_name) -> Optional[BoardModel]:
     return boards.find_by_name(board_name)
 
 
+def find_board_version(board_name: str) -> Optional[str]:
+    return boards.find_board_version(board_name)
+
+
 def find_by_names(names: List[str]) -> List[BoardModel]:
     return boards.find_by_names(names)
 
@@ -42,6 +46,14 @@ def update_configuration(board: BoardModel):
     return boards.update_config(board)
 
 
+def invalidate_board_caches(board: BoardModel):
+    """
+    Drop the caches of all threads and pages of the board, for changes to many threads
+    at once.
+    """
+    boards.bump_generation(board.name)
+
+
 def add_moderator(board: BoardModel, moderator: ModeratorModel):
     return board_moderators.board_add_moderator(board, moderator)
 
@@ -1,5 +1,6 @@
 from typing import Optional
 
+from uchan.lib.broker import Subscription
 from uchan.lib.model import (
     BoardModel,
     BoardPageModel,
@@ -21,12 +22,24 @@ def handle_manage_post(details: ManagePostDetails):
     return post_manage_helper.handle_manage_post(details)
 
 
+def find_thread_by_board_name_thread_refno(
+    board_name: str, thread_refno: int
+) -> Optional[ThreadModel]:
+    return posts.find_thread_by_board_name_thread_refno(board_name, thread_refno)
+
+
 def find_thread_by_board_thread_refno_with_posts(
     board: BoardModel, thread_refno: int
 ) -> "Optional[ThreadModel]":
     return posts.find_thread_by_board_thread_refno_with_posts(board, thread_refno)
 
 
+def find_thread_posts_after(
+    board: BoardModel, thread_refno: int, after_refno: int
+) -> Optional[ThreadModel]:
+    return posts.find_thread_posts_after(board, thread_refno, after_refno)
+
+
 def get_board_page(board: BoardModel, page: int) -> BoardPageModel:
     return posts.get_board_page(board, page)
 
@@ -35,6 +48,28 @@ def get_catalog(board: BoardModel) -> CatalogModel:
     return posts.get_catalog(board)
 
 
+def get_thread_document(
+    board: BoardModel, thread_refno: int, encoding: Optional[str] = None
+) -> Optional[bytes]:
+    return posts.get_thread_document(board, thread_refno, encoding)
+
+
+def get_catalog_document(board: BoardModel, encoding: Optional[str] = None) -> bytes:
+    return posts.get_catalog_document(board, encoding)
+
+
+def subscribe_thread(board: BoardModel, thread_refno: int) -> Subscription:
+    return posts.subscribe_thread(board, thread_refno)
+
+
+def find_thread_version(board: BoardModel, thread_refno: int) -> Optional[str]:
+    return posts.find_thread_version(board, thread_refno)
+
+
+def find_board_pages_version(board: BoardModel) -> str:
+    return posts.find_board_pages_version(board)
+
+
 def find_post(post_id: int) -> PostModel:
     return posts.find_post_by_id(post_id)
 
@@ -1,2 +1,3 @@
+from uchan.lib.tasks import board_task  # noqa
 from uchan.lib.tasks import post_task  # noqa
 from uchan.lib.tasks import report_task  # noqa
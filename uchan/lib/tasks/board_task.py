@@ -0,0 +1,7 @@
+from uchan import celery
+from uchan.lib.repository import posts
+
+
+@celery.task
+def regenerate_board_task(board_name):
+    posts.regenerate_board(board_name)
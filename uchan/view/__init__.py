@@ -1,10 +1,14 @@
+import json
 import logging
 import random
 import string
 from functools import wraps
+from hashlib import sha1
+from typing import Optional
 from urllib.parse import urlparse
 
 from flask import (
+    Response,
     abort,
     jsonify,
     make_response,
@@ -15,15 +19,25 @@ from flask import (
     url_for,
 )
 from markupsafe import Markup, escape
+from werkzeug.exceptions import HTTPException
 
 from uchan import app, config
 from uchan.filter.app_filters import page_formatting
-from uchan.lib import plugin_manager
+from uchan.lib import document_encoding, plugin_manager
+from uchan.lib.cache import (
+    REBUILD_LOCK_TIMEOUT,
+    cache,
+    cache_key,
+    local_cache_channel,
+)
 from uchan.lib.service import board_service, page_service, site_service
 from uchan.lib.utils import ip4_to_str, now
 
 logger = logging.getLogger(__name__)
 
+# Headers of rendered pages that are stored with them
+PAGE_STORED_HEADERS = ["Last-Modified"]
+
 
 class ExtraJavascript:
     def __init__(self):
@@ -137,6 +151,160 @@ def with_cache_control_no_store():
     return decorator
 
 
+def make_etag(*versions) -> Optional[str]:
+    """
+    Make an ETag from the cache versions a response is made of. The versions must be
+    read before the data of the response. None when a version is not known, the
+    response then has no ETag.
+    """
+    if None in versions:
+        return None
+    return sha1("|".join(versions).encode()).hexdigest()
+
+
+def make_page_etag(*versions) -> Optional[str]:
+    """
+    Like make_etag, for rendered pages. Pages also show the site config, the footer
+    pages, the board names and the assets. Moderators get no ETag, their pages have
+    moderator tools on them.
+    """
+    # Imported here, moderator_request imports the services
+    from uchan.lib.moderator_request import get_authed
+
+    if get_authed():
+        return None
+
+    assets = app.jinja_env.globals.get("assets") or []
+    return make_etag(
+        *versions,
+        local_cache_channel.version_tag(),
+        ",".join(map(lambda i: i.url, assets)),
+    )
+
+
+def not_modified_response(etag: Optional[str]):
+    """
+    A 304 response when the client has the version of etag already, otherwise None.
+    """
+    if etag is not None and request.if_none_match.contains_weak(etag):
+        response = make_response("", 304)
+        response.set_etag(etag, weak=True)
+        return response
+    return None
+
+
+def with_etag(response, etag: Optional[str]):
+    response = make_response(response)
+    if etag is not None:
+        response.set_etag(etag, weak=True)
+    return response
+
+
+def request_encoding() -> Optional[str]:
+    """
+    The encoding to send stored documents in, from the Accept-Encoding of the request.
+    """
+    return document_encoding.choose_encoding(request.accept_encodings)
+
+
+def encoded_response(data: bytes, encoding: Optional[str], mimetype: str):
+    """
+    A response of data in encoding, a document stored as it is sent.
+    """
+    response = Response(data, mimetype=mimetype)
+    if encoding is not None:
+        response.headers.set("Content-Encoding", encoding)
+    response.vary.add("Accept-Encoding")
+    return response
+
+
+def page_response(etag: Optional[str], render):
+    """
+    Respond with a rendered page, through the page cache. Pages of anonymous users,
+    which have an etag, are stored with their encodings and served from the cache while
+    the etag is the same. The versions in the etag change where the pages are purged.
+    An outdated page is rendered again by one request, the others get the outdated
+    page in the meantime. render returns the response, or the html of it.
+    """
+    if etag is None or not config.page_cache:
+        return with_etag(render(), etag)
+
+    encoding = request_encoding()
+    key = cache_key("page", request.path)
+    stored = cache.get_raw(document_encoding.encoded_key(key, encoding))
+    if stored is None:
+        return _render_page(key, etag, encoding, render)
+
+    header, data = _parse_stored_page(stored)
+    if header["etag"] != etag:
+        lock_key = "lock$" + key
+        if not cache.add(lock_key, True, timeout=REBUILD_LOCK_TIMEOUT):
+            return _stored_page_response(header, data, encoding)
+        try:
+            return _render_page(key, etag, encoding, render)
+        finally:
+            cache.delete(lock_key)
+
+    return _stored_page_response(header, data, encoding)
+
+
+def _render_page(key: str, etag: str, encoding: Optional[str], render):
+    try:
+        response = make_response(render())
+    except HTTPException:
+        # Don't serve a page that is gone while it is rendered again
+        cache.delete_many(*_stored_page_keys(key))
+        raise
+    if response.status_code != 200:
+        return with_etag(response, etag)
+
+    data = response.get_data()
+    header = {
+        "etag": etag,
+        "headers": {
+            i: response.headers[i] for i in PAGE_STORED_HEADERS if i in response.headers
+        },
+    }
+    encodings = document_encoding.encode_all(data)
+    mapping = {key: _stored_page(header, data)}
+    for i, encoded in encodings.items():
+        mapping[document_encoding.encoded_key(key, i)] = _stored_page(header, encoded)
+    # Pages that are too large are rendered every time.
+    mapping = {k: v for k, v in mapping.items() if len(v) <= cache.max_length}
+    cache.set_many({}, timeout=0, raw_mapping=mapping)
+
+    if encoding is not None:
+        response.set_data(encodings[encoding])
+        response.headers.set("Content-Encoding", encoding)
+    response.vary.add("Accept-Encoding")
+    return with_etag(response, etag)
+
+
+def _stored_page_response(header, data: bytes, encoding: Optional[str]):
+    response = encoded_response(data, encoding, "text/html")
+    response.headers.update(header["headers"])
+    return with_etag(response, header["etag"])
+
+
+def _stored_page_keys(key: str):
+    return [key] + list(
+        map(
+            lambda i: document_encoding.encoded_key(key, i),
+            document_encoding.ENCODINGS,
+        )
+    )
+
+
+def _stored_page(header, data: bytes):
+    # A line of json with the etag and headers, followed by the page
+    return json.dumps(header, separators=(",", ":")).encode() + b"\n" + data
+
+
+def _parse_stored_page(stored: bytes):
+    header, data = stored.split(b"\n", 1)
+    return json.loads(header), data
+
+
 def check_csrf_token(form_token):
     session_token = session.get("_csrf_token", None)
     return (
@@ -193,3 +361,4 @@ import uchan.view.banned  # noqa
 import uchan.view.page  # noqa
 import uchan.view.verify  # noqa
 import uchan.view.boards  # noqa
+import uchan.view.fragments  # noqa
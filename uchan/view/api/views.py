@@ -1,10 +1,28 @@
-from flask import abort
-
-from uchan.lib.model import BoardModel, CatalogModel, PostModel, ThreadModel
-from uchan.lib.service import board_service, file_service, posts_service
-from uchan.lib.utils import valid_id_range
+from typing import Optional
+
+from flask import Response, abort, request
+
+from uchan import config
+from uchan.lib.cache import cache
+from uchan.lib.model import BoardModel
+from uchan.lib.service import api_service, board_service, posts_service
+from uchan.lib.utils import now, valid_id_range
+from uchan.view import (
+    encoded_response,
+    make_etag,
+    not_modified_response,
+    request_encoding,
+    with_etag,
+)
 from uchan.view.api import api, jsonres
 
+# Seconds between comments sent on idle event streams, to keep proxies from closing them
+EVENTS_KEEPALIVE_INTERVAL = 15
+# Milliseconds after which an event stream is closed, the client then reconnects
+EVENTS_MAX_DURATION = 600000
+# Milliseconds the client waits before reconnecting
+EVENTS_RETRY = 5000
+
 
 @api.route("/")
 @jsonres()
@@ -18,91 +36,111 @@ def api_health():
     return {"health": "ok"}
 
 
+@api.route("/metrics")
+def api_metrics():
+    if not cache.metrics:
+        abort(404)
+
+    return Response(cache.metrics.render(), mimetype="text/plain; version=0.0.4")
+
+
 @api.route("/catalog/<board_name>")
-@jsonres()
 def api_catalog(board_name):
     board: BoardModel = board_service.find_board(board_name)
     if not board:
         abort(404)
 
-    catalog: CatalogModel = posts_service.get_catalog(board)
+    etag = make_etag(posts_service.find_board_pages_version(board))
+    not_modified = not_modified_response(etag)
+    if not_modified:
+        return not_modified
 
-    return {"threads": list(map(lambda i: build_thread_object(i), catalog.threads))}
+    encoding = request_encoding()
+    document = posts_service.get_catalog_document(board, encoding)
+
+    return with_etag(json_document_response(document, encoding), etag)
 
 
 @api.route("/thread/<string(maxlength=20):board_name>/<int:thread_refno>")
-@jsonres()
 def api_thread(board_name, thread_refno):
     valid_id_range(thread_refno)
 
+    # With after only the posts after that refno are returned, for the thread watcher
+    after_refno = request.args.get("after", type=int)
+    if after_refno is not None and after_refno < 0:
+        abort(400)
+
     board: BoardModel = board_service.find_board(board_name)
     if not board:
         abort(404)
 
-    thread = posts_service.find_thread_by_board_thread_refno_with_posts(
-        board, thread_refno
-    )
-    if not thread:
-        abort(404)
+    etag = make_etag(posts_service.find_thread_version(board, thread_refno))
+    not_modified = not_modified_response(etag)
+    if not_modified:
+        return not_modified
 
-    return {"thread": build_thread_object(thread)}
+    if after_refno is not None:
+        thread = posts_service.find_thread_posts_after(board, thread_refno, after_refno)
+        if thread is None:
+            abort(404)
 
+        response = json_document_response(api_service.thread_document(thread))
+        # Purging only reaches the url without arguments, don't let varnish keep these.
+        response.headers.set("Cache-Control", "no-cache")
+        return with_etag(response, etag)
 
-def build_thread_object(thread: ThreadModel):
-    thread_obj = {
-        # 'id': thread.id,
-        "refno": thread.refno,
-        "lastModified": thread.last_modified,
-    }
-
-    if thread.locked:
-        thread_obj["locked"] = True
-
-    if thread.sticky:
-        thread_obj["sticky"] = True
-
-    posts = []
+    encoding = request_encoding()
+    document = posts_service.get_thread_document(board, thread_refno, encoding)
+    if document is None:
+        abort(404)
 
-    for post in thread.posts:
-        posts.append(build_post_object(post))
+    return with_etag(json_document_response(document, encoding), etag)
 
-    thread_obj["posts"] = posts
 
-    return thread_obj
+@api.route("/thread/<string(maxlength=20):board_name>/<int:thread_refno>/events")
+def api_thread_events(board_name, thread_refno):
+    """
+    Server-sent events stream with a "post" event with the refno of every new reply.
+    """
+    if not config.thread_events:
+        abort(404)
 
+    valid_id_range(thread_refno)
 
-def build_post_object(post: PostModel):
-    post_obj = {"id": post.id, "refno": post.refno, "date": post.date}
+    board: BoardModel = board_service.find_board(board_name)
+    if not board:
+        abort(404)
 
-    if post.html_text:
-        post_obj["html"] = post.html_text
+    # Only the thread itself, the stream doesn't need the posts
+    thread = posts_service.find_thread_by_board_name_thread_refno(
+        board.name, thread_refno
+    )
+    if not thread:
+        abort(404)
 
-    if post.name:
-        post_obj["name"] = post.name
+    subscription = posts_service.subscribe_thread(board, thread_refno)
 
-    if post.subject:
-        post_obj["subject"] = post.subject
+    def events():
+        try:
+            yield "retry: {}\n\n".format(EVENTS_RETRY)
 
-    if post.mod_code:
-        post_obj["modCode"] = post.mod_code
+            close_at = now() + EVENTS_MAX_DURATION
+            while now() < close_at:
+                post_refno = subscription.get(EVENTS_KEEPALIVE_INTERVAL)
+                if post_refno is None:
+                    yield ": keepalive\n\n"
+                else:
+                    yield "event: post\nid: {0}\ndata: {0}\n\n".format(post_refno)
+        finally:
+            subscription.close()
 
-    if post.files:
-        files_obj = []
-        for file in post.files:
-            file_obj = {
-                "location": file_service.resolve_to_uri(file.location),
-                "thumbnailLocation": file_service.resolve_to_uri(
-                    file.thumbnail_location
-                ),
-                "name": file.original_name,
-                "width": file.width,
-                "height": file.height,
-                "size": file.size,
-                "thumbnailWidth": file.thumbnail_width,
-                "thumbnailHeight": file.thumbnail_height,
-            }
-            files_obj.append(file_obj)
+    response = Response(events(), mimetype="text/event-stream")
+    response.headers.set("Cache-Control", "no-cache")
+    # Don't let nginx buffer the stream
+    response.headers.set("X-Accel-Buffering", "no")
+    return response
 
-        post_obj["files"] = files_obj
 
-    return post_obj
+def json_document_response(document: bytes, encoding: Optional[str] = None):
+    # The documents are stored serialized and encoded, send them as they are.
+    return encoded_response(document, encoding, "application/json")
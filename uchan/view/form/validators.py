@@ -1,3 +1,5 @@
+import ipaddress
+
 from wtforms import ValidationError
 
 from uchan.lib import validation
@@ -15,6 +17,21 @@ class BoardValidator:
         field.board = board
 
 
+class BanAddressValidator:
+    def __call__(self, form, field):
+        try:
+            if ":" in field.data:
+                network = ipaddress.ip_network(field.data, strict=False)
+            else:
+                network = ipaddress.IPv4Address(field.data)
+        except ValueError as e:
+            raise ValidationError(
+                "Invalid IPv4 address or IPv6 address or prefix."
+            ) from e
+        if network.version == 6 and network.prefixlen < 16:
+            raise ValidationError("IPv6 prefix too short.")
+
+
 class BoardNameValidator:
     def __call__(self, form, field):
         if not validation.check_board_name_validity(field.data):
@@ -0,0 +1,137 @@
+import json
+from hashlib import sha1
+from typing import List
+
+from markupsafe import Markup
+
+from uchan import app
+from uchan.lib.cache import cache, cache_key
+from uchan.lib.model import BoardModel, ThreadModel, ThreadStubModel
+from uchan.lib.service import file_service
+
+"""
+Cache of the rendered html of the posts of the thread page, and of the thread stubs of
+the board and catalog pages. The pages splice the fragments instead of rendering every
+post again.
+A fragment is keyed by a version of everything it is rendered from: the post or stub,
+the arguments of the widget and the widget templates. A post that changes gets a new
+key, the old fragment is not read anymore and expires.
+"""
+
+FRAGMENT_TIMEOUT = 24 * 60 * 60
+
+FRAGMENT_TEMPLATES = [
+    "widget/post.html",
+    "widget/board_thread.html",
+    "widget/post_catalog.html",
+]
+
+_render_version = None
+
+
+def thread_posts_html(thread: ThreadModel):
+    items = []
+    for i, post in enumerate(thread.posts):
+        is_op = i == 0
+        args = {
+            "checkbox": True,
+            "with_divider": i != len(thread.posts) - 1,
+            "is_sticky": is_op and thread.sticky,
+            "is_locked": is_op and thread.locked,
+        }
+        items.append(
+            (
+                cache_key("post_html", post.id),
+                [post.to_cache(), args],
+                dict(post_item=post, **args),
+            )
+        )
+    return _render_fragments("widget/post.html", items)
+
+
+def board_threads_html(board: BoardModel, threads: List[ThreadStubModel]):
+    items = []
+    for i, thread in enumerate(threads):
+        with_divider = i != len(threads) - 1
+        items.append(
+            (
+                cache_key("board_thread_html", board.name, thread.refno),
+                [thread.to_cache(), with_divider],
+                {"thread": thread, "board": board, "with_divider": with_divider},
+            )
+        )
+    return _render_fragments("widget/board_thread.html", items)
+
+
+def catalog_threads_html(board: BoardModel, threads: List[ThreadStubModel]):
+    items = []
+    for thread in threads:
+        items.append(
+            (
+                cache_key("catalog_thread_html", board.name, thread.refno),
+                thread.to_cache(),
+                {
+                    "board_name": board.name,
+                    "thread": thread,
+                    "post_item": thread.posts[0],
+                    "is_sticky": thread.sticky,
+                    "is_locked": thread.locked,
+                },
+            )
+        )
+    return _render_fragments("widget/post_catalog.html", items)
+
+
+def _render_fragments(template_name: str, items):
+    """
+    Render the render macro of the template for every item, a tuple of the key of the
+    fragment, the data that the version is made of, and the macro arguments. Cached
+    fragments are read in one round trip.
+    """
+    render_version = _get_render_version()
+    keys = list(
+        map(lambda i: cache_key(i[0], _fragment_version(render_version, i[1])), items)
+    )
+    fragments = cache.get_many(*keys)
+
+    rendered = {}
+    macros = None
+    for i, (key, fragment) in enumerate(zip(keys, fragments, strict=True)):
+        if fragment is None:
+            if macros is None:
+                macros = app.jinja_env.get_template(template_name).module
+            fragment = str(macros.render(**items[i][2]))
+            fragments[i] = fragment
+            rendered[key] = fragment
+
+    if rendered:
+        cache.set_many(rendered, timeout=FRAGMENT_TIMEOUT)
+
+    return Markup("\n".join(fragments))
+
+
+def _fragment_version(render_version: str, data):
+    return sha1(
+        json.dumps([render_version, data], separators=(",", ":")).encode()
+    ).hexdigest()
+
+
+def _get_render_version():
+    """
+    Version of the templates, and of the config the fragments are rendered with.
+    """
+    global _render_version
+    if _render_version is None or app.jinja_env.auto_reload:
+        version = sha1()
+        for template_name in FRAGMENT_TEMPLATES:
+            source, _, _ = app.jinja_env.loader.get_source(app.jinja_env, template_name)
+            version.update(source.encode())
+        # The file urls depend on the cdn config
+        version.update(file_service.resolve_to_uri("0000").encode())
+        _render_version = version.hexdigest()
+    return _render_version
+
+
+app.jinja_env.globals["thread_posts_html"] = thread_posts_html
+app.jinja_env.globals["board_threads_html"] = board_threads_html
+app.jinja_env.globals["catalog_threads_html"] = catalog_threads_html
@@ -20,7 +20,7 @@ from uchan.lib.service import ban_service, posts_service
 from uchan.lib.utils import ip4_to_str, now
 from uchan.view import with_token
 from uchan.view.form import CSRFForm
-from uchan.view.form.validators import BoardNameValidator
+from uchan.view.form.validators import BanAddressValidator, BoardNameValidator
 from uchan.view.mod import mod, mod_role_restrict
 from uchan.view.paged_model import PagedModel
 
@@ -30,15 +30,17 @@ class BanForm(CSRFForm):
     action = ".mod_bans"
 
     ban_ip4 = StringField(
-        "IPv4 address",
-        [DataRequired(), IPAddress(ipv4=True, ipv6=False)],
-        description="IPv4 address to ban.",
+        "IP address",
+        [DataRequired(), BanAddressValidator()],
+        description="IPv4 address to ban, or IPv6 address or prefix, like "
+        "2001:db8:1234::/48.",
         render_kw={"placeholder": "123.123.123.123"},
     )
     ban_ip4_end = StringField(
         "IPv4 address end range",
         [Optional(), IPAddress(ipv4=True, ipv6=False)],
-        description="If specified then IPv4 range from start to end will be banned.",
+        description="If specified then IPv4 range from start to end will be banned. "
+        "Not for IPv6.",
         render_kw={"placeholder": "123.123.123.123"},
     )
     board = StringField(
@@ -87,12 +89,15 @@ def mod_bans():
     if request.method == "POST":
         ban_form = BanForm(request.form)
         if ban_form.validate():
-            ip4 = parse_ip4(ban_form.ban_ip4.data)
+            ip_form = ban_form.ban_ip4.data
             ip4_end_form = ban_form.ban_ip4_end.data
             ip4_end = parse_ip4(ip4_end_form) if ip4_end_form else None
 
             ban = BanModel()
-            ban.ip4 = ip4
+            if ":" in ip_form:
+                ban.ip6 = ip_form
+            else:
+                ban.ip4 = parse_ip4(ip_form)
             if ip4_end is not None:
                 ban.ip4_end = ip4_end
             ban.reason = ban_form.reason.data
@@ -135,6 +140,7 @@ def mod_bans():
         ban_form=ban_form,
         paged_bans=PagedBans(),
         format_ban_until=format_ban_until,
+        format_ban_ip=ban_service.ban_ip_text,
     )
 
 
@@ -135,13 +135,11 @@ def reset_sessions():
 
 
 def _gather_memcache_stats():
-    client = cache._client
-
-    stats = client.get_stats()
+    stats = cache.get_stats()
 
     servers = []
     for stat in stats:
-        s = "server: " + stat[0].decode("utf8") + "\n"
+        s = "server: " + stat[0] + "\n"
         t = []
         for k, v in stat[1].items():
             t.append((k, v))
@@ -1,7 +1,7 @@
 from flask import Response, abort, redirect, render_template, url_for
 from werkzeug.http import http_date
 
-from uchan import app
+from uchan import app, config
 from uchan.lib import validation
 from uchan.lib.model import BoardConfigModel, BoardModel, CatalogModel
 from uchan.lib.moderator_request import get_authed, request_moderator
@@ -12,6 +12,7 @@ from uchan.lib.service import (
     site_service,
 )
 from uchan.lib.utils import valid_id_range
+from uchan.view import make_page_etag, not_modified_response, page_response
 
 
 def get_board_view_params(
@@ -69,19 +70,30 @@ def board(board_name, page=None):
     # Index starts from 0
     index = page - 1
 
-    board_page = posts_service.get_board_page(board, index)
+    etag = make_page_etag(
+        posts_service.find_board_pages_version(board),
+        board_service.find_board_version(board.name),
+    )
+    not_modified = not_modified_response(etag)
+    if not_modified:
+        return not_modified
 
-    # TODO: don't use the board id
-    show_mod_buttons = show_moderator_buttons(board.id)
+    def render():
+        board_page = posts_service.get_board_page(board, index)
 
-    return render_template(
-        "board.html",
-        board=board,
-        board_page=board_page,
-        page_index=index,
-        show_moderator_buttons=show_mod_buttons,
-        **get_board_view_params(board.config, "board", board_name),
-    )
+        # TODO: don't use the board id
+        show_mod_buttons = show_moderator_buttons(board.id)
+
+        return render_template(
+            "board.html",
+            board=board,
+            board_page=board_page,
+            page_index=index,
+            show_moderator_buttons=show_mod_buttons,
+            **get_board_view_params(board.config, "board", board_name),
+        )
+
+    return page_response(etag, render)
 
 
 @app.route("/<string(maxlength=20):board_name>/read/<int:thread_refno>")
@@ -92,34 +104,47 @@ def view_thread(board_name, thread_refno):
     if not board:
         abort(404)
 
-    thread = posts_service.find_thread_by_board_thread_refno_with_posts(
-        board, thread_refno
+    etag = make_page_etag(
+        posts_service.find_thread_version(board, thread_refno),
+        board_service.find_board_version(board.name),
     )
-    if not thread:
-        abort(404)
-
-    additional_page_details = {"threadRefno": thread.refno}
-    if thread.locked:
-        additional_page_details["locked"] = True
-    if thread.sticky:
-        additional_page_details["sticky"] = True
+    not_modified = not_modified_response(etag)
+    if not_modified:
+        return not_modified
 
-    # TODO: don't use the board id
-    show_mod_buttons = show_moderator_buttons(thread.board.id)
-
-    r: Response = app.make_response(
-        render_template(
-            "thread.html",
-            thread=thread,
-            board=thread.board,
-            show_moderator_buttons=show_mod_buttons,
-            **get_board_view_params(
-                board.config, "thread", board_name, additional_page_details
-            ),
+    def render():
+        thread = posts_service.find_thread_by_board_thread_refno_with_posts(
+            board, thread_refno
         )
-    )
-    r.headers["Last-Modified"] = http_date(thread.last_modified / 1000)
-    return r
+        if not thread:
+            abort(404)
+
+        additional_page_details = {"threadRefno": thread.refno}
+        if config.thread_events:
+            additional_page_details["threadEvents"] = True
+        if thread.locked:
+            additional_page_details["locked"] = True
+        if thread.sticky:
+            additional_page_details["sticky"] = True
+
+        # TODO: don't use the board id
+        show_mod_buttons = show_moderator_buttons(thread.board.id)
+
+        r: Response = app.make_response(
+            render_template(
+                "thread.html",
+                thread=thread,
+                board=thread.board,
+                show_moderator_buttons=show_mod_buttons,
+                **get_board_view_params(
+                    board.config, "thread", board_name, additional_page_details
+                ),
+            )
+        )
+        r.headers["Last-Modified"] = http_date(thread.last_modified / 1000)
+        return r
+
+    return page_response(etag, render)
 
 
 @app.route("/<string(maxlength=20):board_name>/catalog")
@@ -128,11 +153,22 @@ def board_catalog(board_name):
     if not board:
         abort(404)
 
-    catalog: CatalogModel = posts_service.get_catalog(board)
-
-    return render_template(
-        "catalog.html",
-        board=board,
-        catalog=catalog,
-        **get_board_view_params(board.config, "catalog", board_name),
+    etag = make_page_etag(
+        posts_service.find_board_pages_version(board),
+        board_service.find_board_version(board.name),
     )
+    not_modified = not_modified_response(etag)
+    if not_modified:
+        return not_modified
+
+    def render():
+        catalog: CatalogModel = posts_service.get_catalog(board)
+
+        return render_template(
+            "catalog.html",
+            board=board,
+            catalog=catalog,
+            **get_board_view_params(board.config, "catalog", board_name),
+        )
+
+    return page_response(etag, render)